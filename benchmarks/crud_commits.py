@@ -0,0 +1,92 @@
+"""Commits and time castor spends storing one proxied request.
+
+Compares the row-at-a-time crud calls with the batched ones castor uses,
+against a SQLite file set up as castor sets it up: in WAL mode with
+synchronous=NORMAL, every commit appends to the log and takes the write
+lock, but is not synced to disk on its own.
+
+    python benchmarks/crud_commits.py --headers 20 --chunks 200 --rounds 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+from typing import Any
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio.session import AsyncSession as Session
+
+from gemini.config import config
+from gemini.database import crud, get_engine, init_db, scoped_session
+
+
+async def row_at_a_time(
+    db_session: Session,
+    session_id: str,
+    headers: list[tuple[str, str]],
+    bodies: list[str],
+) -> None:
+    for name, value in headers:
+        await crud.create_request_header(db_session, session_id, name, value)
+    for index, value in enumerate(bodies):
+        await crud.create_or_update_request_body(db_session, session_id, index, value)
+    for name, value in headers:
+        await crud.create_response_header(db_session, session_id, name, value)
+
+
+async def batched(
+    db_session: Session,
+    session_id: str,
+    headers: list[tuple[str, str]],
+    bodies: list[str],
+) -> None:
+    await crud.create_request_headers(db_session, session_id, headers)
+    await crud.create_request_bodies(db_session, session_id, bodies)
+    await crud.create_response_headers(db_session, session_id, headers)
+
+
+async def main(args: argparse.Namespace) -> None:
+    await init_db()
+    commits = 0
+
+    def count_commit(conn: Any) -> None:
+        nonlocal commits
+        commits += 1
+
+    event.listen(get_engine().sync_engine, "commit", count_commit)
+
+    headers = [(f"x-header-{i}", "v" * 40) for i in range(args.headers)]
+    bodies = ["b" * 2048 for _ in range(args.chunks)]
+    results: dict[str, dict[str, float]] = {}
+    for name, store in (("row_at_a_time", row_at_a_time), ("batched", batched)):
+        commits = 0
+        started = time.perf_counter()
+        for _ in range(args.rounds):
+            async with scoped_session() as db_session:
+                req_session = await crud.create_request_session(db_session)
+                before = commits
+                await store(db_session, req_session.id, headers, bodies)
+                per_request = commits - before
+                await crud.delete_request_session(db_session, req_session.id)
+        elapsed = time.perf_counter() - started
+        results[name] = {
+            "commits_per_request": per_request,
+            "ms_per_request": round(elapsed / args.rounds * 1000, 3),
+        }
+
+    await get_engine().dispose()
+    print(json.dumps({"params": vars(args), "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--headers", type=int, default=20)
+    parser.add_argument("--chunks", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        config.db_url = f"sqlite+aiosqlite:///{os.path.join(tmp, 'bench.db')}"
+        asyncio.run(main(args))
@@ -0,0 +1,233 @@
+"""End-to-end benchmark: client -> pollux -> castor -> upstream.
+
+Starts `benchmarks.upstream`, castor and pollux on localhost and drives a
+mix of requests through pollux, one scenario per body size and response
+size. Reports latency and time-to-first-byte percentiles, throughput, and
+the CPU castor and pollux spend per MB moved, as JSON.
+
+    python benchmarks/e2e.py --body 0 65536 --response 1024 1048576 \\
+        --concurrency 16 --requests 200 --env TUNNEL_MODE=websocket
+
+`--env` settings are passed to both servers, see `gemini.config`.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+from typing import AsyncGenerator
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BODY_CHUNK = b"b" * 65536
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def cpu_seconds(pid: int) -> float | None:
+    # user + system time, Linux only
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+class Servers(object):
+    def __init__(self, env: dict[str, str]):
+        self.env = env
+        self.ports = {name: free_port() for name in ("upstream", "castor", "pollux")}
+        self.procs: dict[str, subprocess.Popen[bytes]] = {}
+
+    def start(self) -> None:
+        env = os.environ | {
+            "ENV": "production",
+            "CASTOR_URL_BASE": f"http://127.0.0.1:{self.ports['castor']}",
+        }
+        env |= self.env
+        apps = {
+            "upstream": "benchmarks.upstream:app",
+            "castor": "gemini.servers.castor:app",
+            "pollux": "gemini.servers.pollux:app",
+        }
+        for name, app in apps.items():
+            self.procs[name] = subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", app, "--log-level", "warning"]
+                + ["--port", str(self.ports[name])],
+                cwd=ROOT,
+                env=env,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+
+        deadline = time.monotonic() + 30
+        for port in self.ports.values():
+            while True:
+                try:
+                    socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                    break
+                except OSError:
+                    if time.monotonic() > deadline:
+                        raise RuntimeError(f"server on port {port} did not start")
+                    time.sleep(0.1)
+
+    def cpu(self) -> dict[str, float | None]:
+        return {
+            name: cpu_seconds(self.procs[name].pid) for name in ("castor", "pollux")
+        }
+
+    def stop(self) -> None:
+        for proc in self.procs.values():
+            proc.terminate()
+        for proc in self.procs.values():
+            proc.wait()
+
+
+async def upload(size: int) -> AsyncGenerator[bytes, None]:
+    while size > 0:
+        yield BODY_CHUNK[:size]
+        size -= len(BODY_CHUNK)
+
+
+def percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def run_scenario(
+    client: httpx.AsyncClient,
+    url: str,
+    args: argparse.Namespace,
+    body_size: int,
+    response_size: int,
+) -> dict[str, object]:
+    headers = {f"x-req-{i}": "v" * 32 for i in range(args.headers)}
+    if body_size:
+        headers["content-length"] = str(body_size)
+    params = {"size": str(response_size), "headers": str(args.headers)}
+    latencies: list[float] = []
+    ttfbs: list[float] = []
+    errors = 0
+    slots = asyncio.Semaphore(args.concurrency)
+
+    async def one() -> None:
+        nonlocal errors
+        async with slots:
+            started = time.perf_counter()
+            try:
+                req = client.build_request(
+                    "POST" if body_size else "GET",
+                    url,
+                    params=params,
+                    headers=headers,
+                    content=upload(body_size) if body_size else None,
+                )
+                resp = await client.send(req, stream=True)
+                received = 0
+                ttfb = None
+                async for chunk in resp.aiter_raw():
+                    if ttfb is None:
+                        ttfb = time.perf_counter() - started
+                    received += len(chunk)
+                await resp.aclose()
+                if (
+                    resp.status_code != 200
+                    or received != response_size
+                    # the upstream echoes how much of the upload reached it
+                    or resp.headers.get("x-received") != str(body_size)
+                ):
+                    errors += 1
+                    return
+            except httpx.HTTPError:
+                errors += 1
+                return
+            latencies.append(time.perf_counter() - started)
+            ttfbs.append(ttfb if ttfb is not None else latencies[-1])
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(args.requests)))
+    elapsed = time.perf_counter() - started
+
+    moved = len(latencies) * (body_size + response_size) / 1e6
+    result: dict[str, object] = {
+        "body_size": body_size,
+        "response_size": response_size,
+        "requests": args.requests,
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(len(latencies) / elapsed, 2),
+        "mb_per_second": round(moved / elapsed, 3),
+    }
+    if latencies:
+        for name, values in (("latency", latencies), ("ttfb", ttfbs)):
+            result[f"{name}_p50_ms"] = round(percentile(values, 0.5) * 1000, 2)
+            result[f"{name}_p99_ms"] = round(percentile(values, 0.99) * 1000, 2)
+    result["_moved_mb"] = moved
+    return result
+
+
+async def main(args: argparse.Namespace, servers: Servers) -> list[dict[str, object]]:
+    proxy = f"http://127.0.0.1:{servers.ports['pollux']}"
+    url = f"http://127.0.0.1:{servers.ports['upstream']}/bench"
+    limits = httpx.Limits(max_connections=args.concurrency)
+    results = []
+    async with httpx.AsyncClient(proxy=proxy, timeout=600, limits=limits) as client:
+        for body_size in args.body:
+            for response_size in args.response:
+                before = servers.cpu()
+                result = await run_scenario(
+                    client, url, args, body_size, response_size
+                )
+                after = servers.cpu()
+                moved = result.pop("_moved_mb")
+                assert isinstance(moved, float)
+                for name in ("castor", "pollux"):
+                    start, end = before[name], after[name]
+                    if start is None or end is None or not moved:
+                        continue
+                    cpu = end - start
+                    result[f"{name}_cpu_ms_per_mb"] = round(cpu * 1000 / moved, 3)
+                results.append(result)
+                print(json.dumps(result), file=sys.stderr)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--body", type=int, nargs="+", default=[0, 65536])
+    parser.add_argument("--response", type=int, nargs="+", default=[1024, 1 << 20])
+    parser.add_argument("--headers", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--env", action="append", default=[], help="KEY=VALUE")
+    parser.add_argument("--output", help="write the JSON report here")
+    args = parser.parse_args()
+
+    env = dict(item.split("=", 1) for item in args.env)
+    servers = Servers(env)
+    servers.start()
+    try:
+        results = asyncio.run(main(args, servers))
+    finally:
+        servers.stop()
+
+    report = {
+        "python": platform.python_version(),
+        "params": {k: v for k, v in vars(args).items() if k != "output"},
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
@@ -0,0 +1,67 @@
+"""Potato throughput, one-shot and streaming, in MB/s of plaintext.
+
+    python benchmarks/potato.py --size 8388608 --chunk 65536
+"""
+import argparse
+import json
+import os
+import secrets
+import time
+from typing import Callable
+
+from gemini.core.potato import Potato, PotatoDecoder, PotatoEncoder
+
+
+def throughput(run: Callable[[], object], size: int) -> float:
+    best = min(_time(run) for _ in range(3))
+    return round(size / best / 1e6, 2)
+
+
+def _time(run: Callable[[], object]) -> float:
+    started = time.perf_counter()
+    run()
+    return time.perf_counter() - started
+
+
+def main(args: argparse.Namespace) -> None:
+    key = secrets.token_urlsafe(24)
+    data = os.urandom(args.size)
+    packed = Potato(key).pack_bytes(data)
+    chunks = [data[i : i + args.chunk] for i in range(0, len(data), args.chunk)]
+    packed_chunks = [
+        packed[i : i + args.chunk] for i in range(0, len(packed), args.chunk)
+    ]
+
+    def stream_encode() -> None:
+        encoder = PotatoEncoder(key)
+        for chunk in chunks:
+            encoder.update(chunk)
+        encoder.flush()
+
+    def stream_decode() -> None:
+        decoder = PotatoDecoder(key)
+        for chunk in packed_chunks:
+            decoder.update(chunk)
+        decoder.flush()
+
+    def row_pack() -> None:
+        # how castor stores a stream upload: one Potato call per row
+        potato = Potato(key)
+        for chunk in chunks:
+            potato.pack_bytes(chunk)
+
+    results = {
+        "pack_bytes": throughput(lambda: Potato(key).pack_bytes(data), args.size),
+        "unpack_bytes": throughput(lambda: Potato(key).unpack_bytes(packed), args.size),
+        "row_pack_bytes": throughput(row_pack, args.size),
+        "encoder": throughput(stream_encode, args.size),
+        "decoder": throughput(stream_decode, args.size),
+    }
+    print(json.dumps({"params": vars(args), "mb_per_second": results}, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=8 * 1024 * 1024)
+    parser.add_argument("--chunk", type=int, default=65536)
+    main(parser.parse_args())
@@ -0,0 +1,80 @@
+"""Re-chunking a body that arrives in network reads of various sizes.
+
+Compares the old `body += chunk; body = body[chunk_size:]` re-chunker with
+`gemini.utils.stream_reader` and `stream_views`.
+
+    python benchmarks/stream_reader.py --read 1024 1048576 --chunk 128
+
+The old one copies the rest of its buffer for every piece, so it falls
+behind as soon as reads are much larger than pieces.
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+from typing import AsyncGenerator, AsyncIterator, Callable
+
+from gemini.utils import stream_reader, stream_views
+
+
+async def concat_reader(
+    stream: AsyncIterator[bytes], chunk_size: int = 128,
+) -> AsyncGenerator[bytes, None]:
+    body = b""
+    async for chunk in stream:
+        body += chunk
+        while len(body) >= chunk_size:
+            yield body[:chunk_size]
+            body = body[chunk_size:]
+
+    if len(body) > 0:
+        yield body
+
+
+async def network(data: bytes, read_size: int) -> AsyncGenerator[bytes, None]:
+    for start in range(0, len(data), read_size):
+        yield data[start : start + read_size]
+
+
+async def measure(
+    reader: Callable[..., AsyncGenerator[bytes | memoryview, None]],
+    data: bytes,
+    read_size: int,
+    chunk_size: int,
+) -> float:
+    started = time.perf_counter()
+    total = 0
+    async for piece in reader(network(data, read_size), chunk_size):
+        total += len(piece)
+    assert total == len(data)
+    return time.perf_counter() - started
+
+
+async def main(args: argparse.Namespace) -> None:
+    data = os.urandom(args.size)
+    results: list[dict[str, float]] = []
+    for read_size in args.read:
+        for chunk_size in args.chunk:
+            result = {"read": read_size, "chunk": chunk_size}
+            for name, reader in (
+                ("concat", concat_reader),
+                ("stream_reader", stream_reader),
+                ("stream_views", stream_views),
+            ):
+                times = [
+                    await measure(reader, data, read_size, chunk_size)
+                    for _ in range(3)
+                ]
+                result[f"{name}_ms"] = round(min(times) * 1000, 3)
+            results.append(result)
+
+    print(json.dumps({"size": args.size, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=8 * 1024 * 1024)
+    parser.add_argument("--read", type=int, nargs="+", default=[1024, 65536, 1 << 20])
+    parser.add_argument("--chunk", type=int, nargs="+", default=[128, 1536])
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,41 @@
+"""Stand-in upstream for `benchmarks/e2e.py`.
+
+Any path and method: the request body is read and discarded, and the
+response is `size` bytes (query parameter) streamed in 64 KiB chunks,
+with `headers` extra response headers.
+
+    python -m uvicorn benchmarks.upstream:app --port 9000
+"""
+from typing import AsyncGenerator
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import StreamingResponse
+from starlette.routing import Route
+
+CHUNK = bytes(range(256)) * 256
+
+
+async def sink(request: Request) -> StreamingResponse:
+    received = 0
+    async for chunk in request.stream():
+        received += len(chunk)
+
+    size = int(request.query_params.get("size", "0"))
+    count = int(request.query_params.get("headers", "0"))
+    headers = {f"x-bench-{i}": "v" * 32 for i in range(count)}
+    headers["content-length"] = str(size)
+    headers["x-received"] = str(received)
+
+    async def body() -> AsyncGenerator[bytes, None]:
+        remaining = size
+        while remaining > 0:
+            yield CHUNK[:remaining]
+            remaining -= len(CHUNK)
+
+    return StreamingResponse(body(), headers=headers)
+
+
+app = Starlette(
+    routes=[Route("/{path:path}", sink, methods=["GET", "POST", "HEAD"])]
+)
@@ -3,22 +3,88 @@ from typing import Literal
 from pydantic import BaseSettings
 
 ENV = Literal["development", "production", "test"]
+UPLOAD_MODE = Literal["chunk", "pipeline", "stream"]
+STORAGE_BACKEND = Literal["sql", "memory"]
+TUNNEL_MODE = Literal["legacy", "frame", "websocket"]
+COMPRESSION = Literal["auto", "zstd", "deflate", "none"]
 
 
 class Config(BaseSettings):
     host: str = "127.0.0.1"
     port: int = 8000
+    workers: int = 1
     env: ENV = "development"
     debug: bool = False
     log_file: str | None = None
+    log_queue_size: int = 10000
+    log_rate_limit: float = 0.0  # records per second and logger, 0 for no limit
+    log_burst: int = 100
+    log_rate_limits: dict[str, float] = {}
+    log_max_field_length: int = 256  # 0 to log payloads in full
 
     secert: str = "change me"
     chunk_size: int = 512
+    body_page_size: int = 64
 
     db_url: str = "sqlite+aiosqlite:///:memory:"
     db_debug: bool = False
+    sqlite_busy_timeout: float = 5.0
+
+    storage_backend: STORAGE_BACKEND = "sql"
+    session_ttl: float = 86400
+    memory_max_sessions: int = 10000
+    memory_max_bytes: int = 256 * 1024 * 1024
+    reaper_interval: float = 60.0
+    reaper_batch_size: int = 500
+
+    session_wait_timeout: float = 1.6
+    response_wait_timeout: float = 30.0
+    event_poll_interval: float = 0.05
+
+    cache_memory_bytes: int = 64 * 1024 * 1024
+    cache_max_entry_bytes: int = 32 * 1024 * 1024
+    cache_disk_dir: str | None = None
+    cache_disk_bytes: int = 1024 * 1024 * 1024
+    cache_disk_threshold: int = 256 * 1024
+    coalesce_requests: bool = True
+    coalesce_buffer_bytes: int = 4 * 1024 * 1024
+    coalesce_stall_timeout: float = 30.0
+    ranged_downloads: bool = False
+    ranged_segment_size: int = 1024 * 1024
+    ranged_concurrency: int = 4
+    ranged_min_size: int = 8 * 1024 * 1024
+    upstream_max_connections_per_host: int = 50
+    upstream_max_keepalive_per_host: int = 10
+    upstream_keepalive_expiry: float = 30.0
+    upstream_max_hosts: int = 256
+    upstream_http2: bool = False
+    upstream_connect_timeout: float = 10.0
+    upstream_read_timeout: float = 60.0
+    upstream_dns_ttl: float = 60.0  # 0 to resolve on every new connection
+    upstream_proxy: str | None = None
+    upstream_trust_env: bool = True  # HTTP(S)_PROXY, NO_PROXY and SSL_CERT_*
 
     castor_url_base: str = "http://127.0.0.1:8000"
+    session_pool_size: int = 8
+    session_pool_refill_interval: float = 5.0
+    session_pool_margin: float = 60.0
+    tunnel_mode: TUNNEL_MODE = "legacy"
+    mux_connections: int = 4
+    mux_max_streams: int = 100
+    mux_window: int = 256 * 1024
+    mux_max_backoff: float = 10.0
+    castor_max_connections: int = 100
+    castor_max_keepalive_connections: int = 20
+    castor_keepalive_expiry: float = 5.0
+    castor_http2: bool = False
+    batch_headers: bool = True
+    inband_headers: bool = True
+    tunnel_compression: COMPRESSION = "auto"
+    pass_encoded: bool = True
+    upload_mode: UPLOAD_MODE = "stream"
+    upload_chunk_size: int = 128
+    upload_window: int = 8
+    upload_retries: int = 3
 
     class Config:
         env_file = ".env"
@@ -0,0 +1,378 @@
+"""Shared HTTP cache for castor's upstream GETs.
+
+Follows the shared-cache rules of RFC 9111 closely enough for static
+assets: `Cache-Control`, `Expires` and `Vary` decide what is stored and for
+how long, and stale entries with an ETag or Last-Modified are revalidated
+with a conditional request. Bodies live in memory, or, past a size
+threshold and when a directory is given, in files read through mmap.
+"""
+import asyncio
+import mmap
+import os
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from itertools import count
+from typing import AsyncIterator, Awaitable, Callable, Iterable
+
+import httpx
+
+from gemini.metrics import cache_requests, cache_saved_bytes
+
+CACHEABLE_STATUS = {200, 203, 204, 300, 301, 308, 404, 405, 410, 414, 501}
+CONDITIONAL_HEADERS = ("if-none-match", "if-modified-since", "if-match", "range")
+# hop-by-hop headers and those a 304 must not overwrite
+NOT_UPDATED = {"content-length", "content-encoding", "transfer-encoding", "age"}
+READ_SIZE = 64 * 1024
+
+Send = Callable[[httpx.Request], Awaitable[httpx.Response]]
+# URL and the values of the request headers its response varies on
+Key = tuple[str, tuple[str | None, ...]]
+
+
+def parse_cache_control(value: str) -> dict[str, str | None]:
+    directives: dict[str, str | None] = {}
+    for part in value.split(","):
+        name, _, arg = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = arg.strip('"') if arg else None
+    return directives
+
+
+def _seconds(value: str | None) -> float | None:
+    try:
+        return max(0.0, float(value)) if value is not None else None
+    except ValueError:
+        return None
+
+
+def _http_date(value: str | None) -> float | None:
+    try:
+        return parsedate_to_datetime(value).timestamp() if value else None
+    except (TypeError, ValueError):
+        return None
+
+
+def freshness_lifetime(headers: httpx.Headers, now: float) -> float:
+    """Seconds a response stays fresh in a shared cache, 0 when it must revalidate."""
+    cc = parse_cache_control(headers.get("cache-control", ""))
+    if "no-cache" in cc or "must-understand" in cc:
+        return 0.0
+    for directive in ("s-maxage", "max-age"):
+        if (lifetime := _seconds(cc.get(directive))) is not None:
+            return lifetime
+    if "expires" in headers:
+        expires = _http_date(headers["expires"])
+        date = _http_date(headers.get("date")) or now
+        return max(0.0, expires - date) if expires is not None else 0.0
+    return 0.0
+
+
+def vary_names(headers: httpx.Headers) -> tuple[str, ...]:
+    names = (n.strip().lower() for n in headers.get("vary", "").split(","))
+    return tuple(sorted(n for n in names if n))
+
+
+class CacheEntry(object):
+    def __init__(
+        self,
+        status_code: int,
+        headers: list[tuple[str, str]],
+        size: int,
+        stored_at: float,
+        expires_at: float,
+        body: bytes | None = None,
+        path: str | None = None,
+    ):
+        self.status_code = status_code
+        self.headers = headers
+        self.size = size
+        self.stored_at = stored_at
+        self.expires_at = expires_at
+        self.body = body
+        self.path = path
+
+    @property
+    def tier(self) -> str:
+        return "memory" if self.path is None else "disk"
+
+    def header(self, name: str) -> str | None:
+        return next((v for n, v in self.headers if n.lower() == name), None)
+
+    def validators(self) -> dict[str, str]:
+        validators: dict[str, str] = {}
+        if etag := self.header("etag"):
+            validators["if-none-match"] = etag
+        if last_modified := self.header("last-modified"):
+            validators["if-modified-since"] = last_modified
+        return validators
+
+    def refresh(self, headers: httpx.Headers, now: float) -> None:
+        """Take the updated headers and freshness of a 304 Not Modified."""
+        updated = {n.lower(): v for n, v in headers.multi_items()}
+        for name in NOT_UPDATED:
+            updated.pop(name, None)
+        kept = [(n, v) for n, v in self.headers if n.lower() not in updated]
+        self.headers = kept + list(updated.items())
+        self.stored_at = now
+        # a 304 may carry only some of the headers freshness depends on
+        self.expires_at = now + freshness_lifetime(httpx.Headers(self.headers), now)
+
+    def response(self, request: httpx.Request, now: float) -> httpx.Response:
+        headers = [(n, v) for n, v in self.headers if n.lower() != "age"]
+        headers.append(("age", str(int(now - self.stored_at))))
+        return httpx.Response(
+            self.status_code,
+            headers=headers,
+            stream=CachedStream(self),
+            request=request,
+        )
+
+
+class CachedStream(httpx.AsyncByteStream):
+    """The body of a cache entry, read from memory or a memory-mapped file.
+
+    The file is mapped right away, so evicting the entry meanwhile is safe.
+    """
+
+    def __init__(self, entry: CacheEntry):
+        self.body = entry.body
+        self.map: mmap.mmap | None = None
+        if entry.path is not None and entry.size:
+            with open(entry.path, "rb") as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        data = self.map if self.map is not None else self.body or b""
+        try:
+            for start in range(0, len(data), READ_SIZE):
+                yield data[start : start + READ_SIZE]
+        finally:
+            await self.aclose()
+
+    async def aclose(self) -> None:
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
+class TeeStream(httpx.AsyncByteStream):
+    """Pass an upstream body through, storing it once it was read to the end."""
+
+    def __init__(self, resp: httpx.Response, cache: "ResponseCache"):
+        self.resp = resp
+        self.cache = cache
+        self.parts: list[bytes] | None = []
+        self.size = 0
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self.resp.aiter_raw():
+            if self.parts is not None:
+                self.size += len(chunk)
+                if self.size > self.cache.max_entry_bytes:
+                    self.parts = None
+                else:
+                    self.parts.append(chunk)
+            yield chunk
+
+        if self.parts is not None:
+            await self.cache.store(self.resp, self.parts, self.size)
+
+    async def aclose(self) -> None:
+        await self.resp.aclose()
+
+
+class ResponseCache(object):
+    """LRU cache of upstream responses, keyed by URL and `Vary`ing headers.
+
+    Bodies of at least `disk_threshold` bytes go to files under `disk_dir`
+    when one is given; each tier evicts its least recently used entries to
+    stay within its byte budget. Only whole bodies of at most
+    `max_entry_bytes` are stored.
+    """
+
+    def __init__(
+        self,
+        memory_bytes: int,
+        max_entry_bytes: int,
+        disk_dir: str | None = None,
+        disk_bytes: int = 0,
+        disk_threshold: int = 0,
+    ):
+        self.budgets = {"memory": memory_bytes, "disk": disk_bytes}
+        self.used = {"memory": 0, "disk": 0}
+        self.max_entry_bytes = max_entry_bytes
+        self.disk_threshold = disk_threshold
+        self.disk_dir: str | None = None
+        if disk_dir is not None and disk_bytes > 0:
+            os.makedirs(disk_dir, exist_ok=True)
+            self.disk_dir = tempfile.mkdtemp(prefix="castor-", dir=disk_dir)
+        self._entries: OrderedDict[Key, CacheEntry] = OrderedDict()
+        self._vary: dict[str, tuple[str, ...]] = {}  # url -> varying headers
+        self._variants: dict[str, int] = {}  # url -> entries stored for it
+        self._file_ids = count()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _key(self, request: httpx.Request, names: Iterable[str]) -> Key:
+        return (str(request.url), tuple(request.headers.get(n) for n in names))
+
+    def lookup(self, request: httpx.Request) -> CacheEntry | None:
+        key = self._key(request, self._vary.get(str(request.url), ()))
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    async def send(self, request: httpx.Request, send: Send) -> httpx.Response:
+        """`send(request)`, answered from the cache if it can."""
+        cc = parse_cache_control(request.headers.get("cache-control", ""))
+        if (
+            request.method != "GET"
+            or "no-store" in cc
+            or any(name in request.headers for name in CONDITIONAL_HEADERS)
+        ):
+            return await send(request)
+
+        now = time.time()
+        entry = self.lookup(request)
+        revalidate = (
+            "no-cache" in cc
+            or cc.get("max-age") == "0"
+            or request.headers.get("pragma", "").lower() == "no-cache"
+        )
+        if entry is not None and not revalidate and now < entry.expires_at:
+            cache_requests.inc("hit")
+            cache_saved_bytes.inc(amount=entry.size)
+            return entry.response(request, now)
+
+        validators = entry.validators() if entry is not None else {}
+        request.headers.update(validators)
+        resp = await send(request)
+        for name in validators:
+            del request.headers[name]
+        if entry is not None and validators and resp.status_code == 304:
+            await resp.aclose()
+            entry.refresh(resp.headers, now)
+            try:
+                cached = entry.response(request, now)
+            except OSError:
+                # evicted meanwhile, and its file with it
+                resp = await send(request)
+            else:
+                cache_requests.inc("revalidated")
+                cache_saved_bytes.inc(amount=entry.size)
+                return cached
+
+        cache_requests.inc("miss")
+        if not self.storable(request, resp):
+            return resp
+        return httpx.Response(
+            resp.status_code,
+            headers=resp.headers.multi_items(),
+            stream=TeeStream(resp, self),
+            request=request,
+            extensions=resp.extensions,
+        )
+
+    def storable(self, request: httpx.Request, resp: httpx.Response) -> bool:
+        cc = parse_cache_control(resp.headers.get("cache-control", ""))
+        if (
+            resp.status_code not in CACHEABLE_STATUS
+            or "no-store" in cc
+            or "private" in cc
+            or "set-cookie" in resp.headers
+            or "*" in vary_names(resp.headers)
+        ):
+            return False
+        if "authorization" in request.headers and not (
+            "public" in cc or "s-maxage" in cc or "must-revalidate" in cc
+        ):
+            return False
+        length = resp.headers.get("content-length")
+        if length is not None and length.isdigit():
+            if int(length) > self.max_entry_bytes:
+                return False
+        lifetime = freshness_lifetime(resp.headers, time.time())
+        return lifetime > 0 or "etag" in resp.headers or "last-modified" in resp.headers
+
+    async def store(self, resp: httpx.Response, parts: list[bytes], size: int) -> None:
+        now = time.time()
+        lifetime = freshness_lifetime(resp.headers, now)
+        age = _seconds(resp.headers.get("age")) or 0.0
+        entry = CacheEntry(
+            resp.status_code,
+            resp.headers.multi_items(),
+            size,
+            stored_at=now - age,
+            expires_at=now + lifetime - age,
+        )
+        if self.disk_dir is not None and size >= self.disk_threshold:
+            entry.path = os.path.join(self.disk_dir, str(next(self._file_ids)))
+            await asyncio.to_thread(_write_file, entry.path, parts)
+        else:
+            entry.body = b"".join(parts)
+        if size > self.budgets[entry.tier]:
+            _unlink(entry.path)
+            return
+
+        url = str(resp.request.url)
+        names = vary_names(resp.headers)
+        if self._vary.get(url, names) != names:
+            # the response varies on other headers now, older variants are moot
+            for key in [key for key in self._entries if key[0] == url]:
+                self._remove(key)
+
+        key = self._key(resp.request, names)
+        if key in self._entries:
+            self._remove(key)
+        self._vary[url] = names
+        self._entries[key] = entry
+        self._variants[url] = self._variants.get(url, 0) + 1
+        self.used[entry.tier] += size
+        for key in list(self._entries):
+            if self.used[entry.tier] <= self.budgets[entry.tier]:
+                break
+            if self._entries[key].tier == entry.tier:
+                self._remove(key)
+
+    def _remove(self, key: Key) -> None:
+        entry = self._entries.pop(key)
+        self.used[entry.tier] -= entry.size
+        _unlink(entry.path)
+
+        url = key[0]
+        self._variants[url] -= 1
+        if not self._variants[url]:
+            del self._variants[url], self._vary[url]
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "memory_bytes": self.used["memory"],
+            "disk_bytes": self.used["disk"],
+        }
+
+    def close(self) -> None:
+        self._entries.clear()
+        self._vary.clear()
+        self._variants.clear()
+        self.used = {"memory": 0, "disk": 0}
+        if self.disk_dir is not None:
+            shutil.rmtree(self.disk_dir, ignore_errors=True)
+
+
+def _unlink(path: str | None) -> None:
+    if path is not None:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+def _write_file(path: str, parts: list[bytes]) -> None:
+    with open(path, "wb") as f:
+        f.writelines(parts)
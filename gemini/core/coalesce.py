@@ -0,0 +1,280 @@
+"""Single-flight upstream fetches for identical concurrent requests.
+
+The first request for a key starts a flight; requests for the same key that
+arrive before its body starts flowing join it, and every one of them gets
+its own `httpx.Response` over the one upstream body.
+"""
+import asyncio
+import logging
+from collections import deque
+from functools import partial
+from typing import AsyncIterator, Awaitable, Callable
+
+import httpx
+
+from gemini.metrics import coalesced_requests
+
+logger = logging.getLogger("gemini.coalesce")
+
+Fetch = Callable[[httpx.AsyncClient, httpx.Request], Awaitable[httpx.Response]]
+FlightKey = tuple[str, str, tuple[tuple[str, str], ...]]
+
+IDEMPOTENT_METHODS = ("GET", "HEAD")
+# per connection headers that do not change what the upstream answers
+IGNORED_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-connection",
+    "proxy-authorization",
+    "te",
+    "upgrade",
+    "content-length",
+}
+
+
+class Detached(Exception):
+    """A subscriber left its flight before reading, to fetch on its own."""
+
+
+class Diverged(Exception):
+    pass
+
+
+class Stalled(Exception):
+    """A subscriber stopped reading and held up the rest of its flight."""
+
+
+def flight_key(request: httpx.Request) -> FlightKey:
+    headers = sorted(
+        (name, value)
+        for name, value in request.headers.multi_items()
+        if name not in IGNORED_HEADERS
+    )
+    return (request.method, str(request.url), tuple(headers))
+
+
+class Subscriber(object):
+    def __init__(self, flight: "Flight"):
+        self.flight = flight
+        self.chunks: deque[bytes] = deque()
+        self.buffered = 0
+        self.started = False  # has handed out a chunk
+        self.read_at = 0.0  # loop time of the last chunk handed out
+        self.ready = asyncio.Event()
+        self.done = False
+        self.error: BaseException | None = None
+
+    def push(self, chunk: bytes) -> None:
+        self.chunks.append(chunk)
+        self.buffered += len(chunk)
+        self.ready.set()
+
+    def finish(self, error: BaseException | None = None) -> None:
+        self.done = True
+        self.error = error
+        self.ready.set()
+
+    def detach(self) -> None:
+        self.chunks.clear()
+        self.buffered = 0
+        self.finish(Detached())
+
+
+class SubscriberStream(httpx.AsyncByteStream):
+    """A subscriber's share of the flight, or its own fetch once detached.
+
+    `refetch` sends the subscriber's request again. The response headers are
+    out by then, so a refetched body that would not match them is refused.
+    """
+
+    def __init__(
+        self,
+        subscriber: Subscriber,
+        head: httpx.Response,
+        refetch: Callable[[], Awaitable[httpx.Response]],
+    ):
+        self.subscriber = subscriber
+        self.head = head
+        self.refetch = refetch
+        self.private: httpx.Response | None = None
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        sub = self.subscriber
+        try:
+            while True:
+                if sub.chunks:
+                    chunk = sub.chunks.popleft()
+                    sub.buffered -= len(chunk)
+                    sub.started = True
+                    sub.read_at = asyncio.get_running_loop().time()
+                    sub.flight.drained.set()
+                    yield chunk
+                elif sub.done:
+                    if isinstance(sub.error, Detached):
+                        async for chunk in self.fetch_privately():
+                            yield chunk
+                    elif sub.error is not None:
+                        raise sub.error
+                    return
+                else:
+                    sub.ready.clear()
+                    await sub.ready.wait()
+        finally:
+            await self.aclose()
+
+    async def fetch_privately(self) -> AsyncIterator[bytes]:
+        self.private = resp = await self.refetch()
+        if resp.status_code != self.head.status_code:
+            raise Diverged(f"refetched response has status {resp.status_code}")
+        for name in ("content-length", "content-encoding", "etag"):
+            if resp.headers.get(name) != self.head.headers.get(name):
+                raise Diverged(f"refetched response has another {name}")
+        async for chunk in resp.aiter_raw():
+            yield chunk
+
+    async def aclose(self) -> None:
+        self.subscriber.flight.leave(self.subscriber)
+        if self.private is not None:
+            await self.private.aclose()
+
+
+class Flight(object):
+    """One upstream fetch, relayed to every subscriber.
+
+    A subscriber that gets `buffer_bytes` behind before reading anything is
+    detached to fetch on its own, so it cannot hold up the others. Once a
+    subscriber has read part of the body, the flight waits for it instead,
+    but for no more than `stall_timeout` seconds without it reading.
+    """
+
+    def __init__(self, buffer_bytes: int, stall_timeout: float):
+        self.buffer_bytes = buffer_bytes
+        self.stall_timeout = stall_timeout
+        self.subscribers: list[Subscriber] = []
+        self.head: asyncio.Future[httpx.Response] = (
+            asyncio.get_running_loop().create_future()
+        )
+        self.drained = asyncio.Event()
+
+    def join(self) -> Subscriber:
+        subscriber = Subscriber(self)
+        self.subscribers.append(subscriber)
+        return subscriber
+
+    def leave(self, subscriber: Subscriber) -> None:
+        if subscriber in self.subscribers:
+            self.subscribers.remove(subscriber)
+            self.drained.set()
+
+    async def relay(self, resp: httpx.Response) -> None:
+        async for chunk in resp.aiter_raw():
+            while True:
+                for sub in list(self.subscribers):
+                    if sub.buffered >= self.buffer_bytes and not sub.started:
+                        self.subscribers.remove(sub)
+                        sub.detach()
+                        coalesced_requests.inc("detached")
+                if all(sub.buffered < self.buffer_bytes for sub in self.subscribers):
+                    break
+                self.drained.clear()
+                try:
+                    await asyncio.wait_for(self.drained.wait(), self.stall_timeout)
+                except asyncio.TimeoutError:
+                    self.drop_stalled()
+            if not self.subscribers:
+                return
+
+            for sub in self.subscribers:
+                sub.push(chunk)
+
+        for sub in self.subscribers:
+            sub.finish()
+
+    def drop_stalled(self) -> None:
+        now = asyncio.get_running_loop().time()
+        for sub in list(self.subscribers):
+            full = sub.buffered >= self.buffer_bytes
+            if full and now - sub.read_at >= self.stall_timeout:
+                self.subscribers.remove(sub)
+                sub.finish(Stalled(f"no reads for {self.stall_timeout}s"))
+                coalesced_requests.inc("stalled")
+
+
+class Coalescer(object):
+    """Share one upstream fetch among identical idempotent requests.
+
+    Flights fetch with the client from `get_client` rather than the one of
+    the request that started them, which may be gone before the body is.
+    """
+
+    def __init__(
+        self,
+        get_client: Callable[[], httpx.AsyncClient],
+        buffer_bytes: int,
+        stall_timeout: float,
+    ):
+        self.get_client = get_client
+        self.buffer_bytes = buffer_bytes
+        self.stall_timeout = stall_timeout
+        self._flights: dict[FlightKey, Flight] = {}
+        self._tasks: set[asyncio.Task[None]] = set()
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    async def aclose(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def send(self, request: httpx.Request, fetch: Fetch) -> httpx.Response:
+        key = flight_key(request)
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = Flight(self.buffer_bytes, self.stall_timeout)
+            task = asyncio.create_task(self._fly(key, flight, request, fetch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            coalesced_requests.inc("leader")
+        else:
+            coalesced_requests.inc("follower")
+
+        subscriber = flight.join()
+        try:
+            resp = await asyncio.shield(flight.head)
+        except BaseException:
+            flight.leave(subscriber)
+            raise
+        client = self.get_client()
+        return httpx.Response(
+            resp.status_code,
+            headers=resp.headers.multi_items(),
+            stream=SubscriberStream(subscriber, resp, partial(fetch, client, request)),
+            request=request,
+            extensions=resp.extensions,
+        )
+
+    async def _fly(
+        self, key: FlightKey, flight: Flight, request: httpx.Request, fetch: Fetch,
+    ) -> None:
+        try:
+            resp = await fetch(self.get_client(), request)
+        except asyncio.CancelledError:
+            flight.head.cancel()
+            raise
+        except Exception as e:
+            flight.head.set_exception(e)
+            return
+        finally:
+            # late comers would miss the start of the body
+            del self._flights[key]
+
+        flight.head.set_result(resp)
+        try:
+            await flight.relay(resp)
+        except Exception as e:
+            logger.warning("Shared Fetch Failed - %s %r", request.url, e)
+            for sub in flight.subscribers:
+                sub.finish(e)
+        finally:
+            await resp.aclose()
@@ -0,0 +1,161 @@
+"""Payload compression for the tunnel, applied before Potato.
+
+Codecs are negotiated per request: pollux offers the codecs it can read
+and castor picks the first of its own preference among them for the
+response. Request bodies always use deflate, which every peer has.
+"""
+import zlib
+from types import ModuleType
+from typing import AsyncGenerator, AsyncIterator, Iterable, Mapping
+
+from gemini.metrics import compression_bytes, compression_ratio, compression_skipped
+
+try:
+    import zstandard as _zstandard
+
+    zstandard: ModuleType | None = _zstandard
+except ImportError:
+    zstandard = None
+
+ZLIB_LEVEL = 1
+ZSTD_LEVEL = 3
+PREFERENCE = ("zstd", "deflate")
+REQUEST_CODEC = "deflate"
+
+# Formats that are compressed already, by content type prefix.
+INCOMPRESSIBLE_TYPES = (
+    "image/",
+    "video/",
+    "audio/",
+    "font/woff",
+    "application/zip",
+    "application/gzip",
+    "application/x-gzip",
+    "application/zstd",
+    "application/x-bzip2",
+    "application/x-xz",
+    "application/x-7z-compressed",
+    "application/vnd.rar",
+    "application/x-rar-compressed",
+)
+
+
+def available_codecs(setting: str = "auto") -> list[str]:
+    """Codecs this process can use for `setting` ("auto", a codec or "none")."""
+    installed = [c for c in PREFERENCE if c != "zstd" or zstandard is not None]
+    if setting == "auto":
+        return installed
+    return [setting] if setting in installed else []
+
+
+def choose_codec(offered: Iterable[str], setting: str = "auto") -> str | None:
+    offered = set(offered)
+    return next((c for c in available_codecs(setting) if c in offered), None)
+
+
+def skip_reason(headers: Mapping[str, str]) -> str | None:
+    """Why a body with `headers` is not worth compressing, if it is not."""
+    encoding = headers.get("content-encoding", "identity").strip().lower()
+    if encoding not in ("", "identity"):
+        return "encoded"
+    content_type = headers.get("content-type", "").lower()
+    if content_type.startswith(INCOMPRESSIBLE_TYPES) and "svg" not in content_type:
+        return "content_type"
+    return None
+
+
+class Compressor(object):
+    """Streaming compressor whose output is readable after every `compress`."""
+
+    def __init__(self, codec: str):
+        self.codec = codec
+        if codec == "zstd":
+            if zstandard is None:
+                raise ValueError("zstd is not installed")
+            self._obj = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+            self._sync = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        elif codec == "deflate":
+            self._obj = zlib.compressobj(ZLIB_LEVEL)
+            self._sync = zlib.Z_SYNC_FLUSH
+        else:
+            raise ValueError(f"unknown codec {codec!r}")
+        self.raw_size = 0
+        self.compressed_size = 0
+
+    def compress(self, data: bytes) -> bytes:
+        if not data:
+            return b""
+        self.raw_size += len(data)
+        # flush every chunk, a streamed response must not wait for more data
+        out = self._obj.compress(data) + self._obj.flush(self._sync)
+        self.compressed_size += len(out)
+        return out
+
+    def flush(self) -> bytes:
+        out = self._obj.flush()
+        self.compressed_size += len(out)
+        return out
+
+
+class Decompressor(object):
+    def __init__(self, codec: str):
+        if codec == "zstd":
+            if zstandard is None:
+                raise ValueError("zstd is not installed")
+            self._obj = zstandard.ZstdDecompressor().decompressobj()
+        elif codec == "deflate":
+            self._obj = zlib.decompressobj()
+        else:
+            raise ValueError(f"unknown codec {codec!r}")
+
+    def decompress(self, data: bytes) -> bytes:
+        return self._obj.decompress(data) if data else b""
+
+    def flush(self) -> bytes:
+        out = self._obj.flush()
+        if not self._obj.eof:
+            raise ValueError("truncated compressed stream")
+        return out
+
+
+async def compress_stream(
+    stream: AsyncIterator[bytes], codec: str, direction: str,
+) -> AsyncGenerator[bytes, None]:
+    """Compress `stream` and record its ratio once it is done."""
+    compressor = Compressor(codec)
+    async for chunk in stream:
+        if data := compressor.compress(chunk):
+            yield data
+    yield compressor.flush()
+
+    raw, compressed = compressor.raw_size, compressor.compressed_size
+    compression_bytes.inc(codec, "raw", amount=raw)
+    compression_bytes.inc(codec, "compressed", amount=compressed)
+    if raw:
+        compression_ratio.observe(codec, direction, value=compressed / raw)
+
+
+async def decompress_stream(
+    stream: AsyncIterator[bytes], codec: str,
+) -> AsyncGenerator[bytes, None]:
+    decompressor = Decompressor(codec)
+    async for chunk in stream:
+        if data := decompressor.decompress(chunk):
+            yield data
+    if data := decompressor.flush():
+        yield data
+
+
+def maybe_compress(
+    stream: AsyncGenerator[bytes, None],
+    codec: str | None,
+    direction: str,
+    headers: Mapping[str, str],
+) -> tuple[AsyncGenerator[bytes, None], str | None]:
+    """`stream` compressed with `codec` unless that is pointless, and the codec."""
+    if codec is None:
+        return stream, None
+    if reason := skip_reason(headers):
+        compression_skipped.inc(reason)
+        return stream, None
+    return compress_stream(stream, codec, direction), codec
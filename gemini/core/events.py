@@ -0,0 +1,65 @@
+import asyncio
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Iterator, TypeVar
+
+T = TypeVar("T")
+
+
+class EventBoard(object):
+    """Wake up coroutines waiting for a key, e.g. a session id, to be ready.
+
+    Waiters register with `watch` *before* checking the state they wait for,
+    so a `notify` that lands between the check and the wait is not lost.
+    """
+
+    def __init__(self) -> None:
+        self._waiters: defaultdict[str, set[asyncio.Event]] = defaultdict(set)
+
+    def notify(self, key: str) -> None:
+        for event in self._waiters.get(key, ()):
+            event.set()
+
+    @contextmanager
+    def watch(self, key: str) -> Iterator[asyncio.Event]:
+        event = asyncio.Event()
+        self._waiters[key].add(event)
+        try:
+            yield event
+        finally:
+            waiters = self._waiters[key]
+            waiters.discard(event)
+            if not waiters:
+                del self._waiters[key]
+
+
+async def wait_for_event(event: asyncio.Event, timeout: float) -> bool:
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+    except asyncio.TimeoutError:
+        return False
+    return True
+
+
+async def wait_until(
+    check: Callable[[], Awaitable[T]],
+    event: asyncio.Event,
+    timeout: float,
+    poll_interval: float | None = None,
+) -> T:
+    """Run `check` until it returns something truthy or `timeout` passes.
+
+    `check` runs again whenever `event` is set and, given `poll_interval`, at
+    least that often, to catch changes made by other worker processes that
+    an `EventBoard` never hears about.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    result = await check()
+    while not result and (remaining := deadline - loop.time()) > 0:
+        if poll_interval is not None:
+            remaining = min(remaining, poll_interval)
+        await wait_for_event(event, remaining)
+        event.clear()
+        result = await check()
+    return result
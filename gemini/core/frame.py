@@ -0,0 +1,74 @@
+import struct
+from enum import IntEnum
+from typing import AsyncGenerator, AsyncIterator
+
+from gemini.core.potato import Potato
+
+FRAME_HEADER = struct.Struct("!BI")  # frame type, sealed payload size
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+class FrameType(IntEnum):
+    HELLO = 1  # session secret, sealed with the shared secret
+    HEADER = 2  # json metadata: method/url/headers or status/headers
+    BODY = 3
+    END = 4
+    ERROR = 5
+    WINDOW = 6  # flow control credit, only used by `gemini.core.mux`
+
+
+class FrameError(Exception):
+    pass
+
+
+def pack_frame(kind: FrameType, payload: bytes, potato: Potato) -> bytes:
+    sealed = potato.pack_bytes(payload)
+    return FRAME_HEADER.pack(kind, len(sealed)) + sealed
+
+
+class FrameReader(object):
+    """Read frames written by `pack_frame` from a byte stream of any chunking.
+
+    Frames must be opened in the order they were sealed, with the same key;
+    `potato` may be swapped once the session secret is known.
+    """
+
+    def __init__(self, stream: AsyncIterator[bytes], potato: Potato):
+        self.potato = potato
+        self._stream = stream.__aiter__()
+        self._buffer = bytearray()
+
+    async def _fill(self, size: int) -> bool:
+        while len(self._buffer) < size:
+            try:
+                chunk = await self._stream.__anext__()
+            except StopAsyncIteration:
+                return False
+            self._buffer += chunk
+        return True
+
+    async def read(self) -> tuple[FrameType, bytes] | None:
+        if not await self._fill(FRAME_HEADER.size):
+            if self._buffer:
+                raise FrameError("truncated frame header")
+            return None
+
+        kind, size = FRAME_HEADER.unpack_from(self._buffer)
+        if size > MAX_FRAME_SIZE:
+            raise FrameError(f"frame of {size} bytes is too large")
+        end = FRAME_HEADER.size + size
+        if not await self._fill(end):
+            raise FrameError("truncated frame payload")
+
+        with memoryview(self._buffer) as view:
+            sealed = bytes(view[FRAME_HEADER.size : end])
+        del self._buffer[:end]
+        return FrameType(kind), self.potato.unpack_bytes(sealed)
+
+    async def remainder(self) -> AsyncGenerator[bytes, None]:
+        """Raw bytes that follow the frames read so far."""
+        if self._buffer:
+            yield bytes(self._buffer)
+            self._buffer.clear()
+        async for chunk in self._stream:
+            yield chunk
@@ -0,0 +1,323 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import secrets
+import struct
+from typing import AsyncGenerator, Awaitable, Callable
+
+import websockets
+
+from gemini.core.frame import FrameType
+from gemini.core.potato import Potato
+
+logger = logging.getLogger("gemini.mux")
+
+MUX_HEADER = struct.Struct("!IB")  # stream id, frame type
+WINDOW_UPDATE = struct.Struct("!I")  # bytes the receiver has consumed
+MAX_CHUNK_SIZE = 64 * 1024
+
+
+class StreamReset(Exception):
+    pass
+
+
+class MuxStream(object):
+    """One proxied request inside a `MuxConnection`.
+
+    Frames are sealed in send order with a `Potato` keyed for the stream and
+    direction, so no two keystreams of a connection overlap. BODY
+    frames are flow controlled: the sender may have at most `window` bytes
+    in flight until the receiver acknowledges them with WINDOW frames.
+    """
+
+    def __init__(self, conn: "MuxConnection", stream_id: int):
+        self.conn = conn
+        self.id = stream_id
+        self.task: asyncio.Task[None] | None = None
+        client = not conn.accept_streams
+        self._seal = Potato(conn.stream_secret(stream_id, client))
+        self._open = Potato(conn.stream_secret(stream_id, not client))
+        self._inbox: asyncio.Queue[tuple[FrameType, bytes]] = asyncio.Queue()
+        self._credit = conn.window
+        self._credit_changed = asyncio.Event()
+        self._consumed = 0
+        self._sent_end = False
+        self._received_end = False
+        self._reset = False
+
+    async def send(self, kind: FrameType, payload: bytes = b"") -> None:
+        if kind != FrameType.BODY:
+            self._sent_end = kind in (FrameType.END, FrameType.ERROR)
+            await self.conn._send(self.id, kind, self._seal.pack_bytes(payload))
+            return
+
+        with memoryview(payload) as view:
+            for start in range(0, len(view), MAX_CHUNK_SIZE):
+                while self._credit <= 0:
+                    # _fail() may have run while the last piece was sent
+                    if self._reset:
+                        raise StreamReset("stream reset by peer")
+                    self._credit_changed.clear()
+                    await self._credit_changed.wait()
+                if self._reset:
+                    raise StreamReset("stream reset by peer")
+
+                piece = self._seal.pack_bytes(view[start : start + MAX_CHUNK_SIZE])
+                self._credit -= min(MAX_CHUNK_SIZE, len(view) - start)
+                await self.conn._send(self.id, FrameType.BODY, piece)
+
+    async def receive(self) -> tuple[FrameType, bytes]:
+        kind, payload = await self._inbox.get()
+        if kind == FrameType.ERROR:
+            raise StreamReset(payload.decode(errors="replace"))
+
+        if kind == FrameType.BODY:
+            self._consumed += len(payload)
+            if self._consumed >= self.conn.window // 2:
+                update = WINDOW_UPDATE.pack(self._consumed)
+                self._consumed = 0
+                await self.conn._send(self.id, FrameType.WINDOW, update)
+
+        return kind, payload
+
+    async def body(self) -> AsyncGenerator[bytes, None]:
+        while True:
+            kind, payload = await self.receive()
+            if kind == FrameType.END:
+                return
+            if kind == FrameType.BODY:
+                yield payload
+
+    async def close(self, reason: str = "cancelled") -> None:
+        """Release the stream, resetting it on the peer if it is unfinished."""
+        finished = self._sent_end and self._received_end
+        if not finished and not self.conn.closed:
+            self._sent_end = True
+            try:
+                sealed = self._seal.pack_bytes(reason.encode())
+                await self.conn._send(self.id, FrameType.ERROR, sealed)
+            except Exception:
+                pass
+        self.conn._release(self)
+
+    def _deliver(self, kind: FrameType, payload: bytes) -> None:
+        if kind == FrameType.WINDOW:
+            self._credit += WINDOW_UPDATE.unpack(payload)[0]
+            self._credit_changed.set()
+            return
+
+        self._inbox.put_nowait((kind, self._open.unpack_bytes(payload)))
+        if kind == FrameType.END:
+            self._received_end = True
+        elif kind == FrameType.ERROR:
+            self._fail(None)
+
+    def _fail(self, reason: str | None) -> None:
+        if reason is not None:
+            self._inbox.put_nowait((FrameType.ERROR, reason.encode()))
+        self._received_end = True
+        self._reset = True
+        self._credit_changed.set()
+        if self.task is not None:
+            self.task.cancel()
+
+
+class MuxConnection(object):
+    """Stream-ID-tagged frames over one message-oriented socket.
+
+    Every message is `MUX_HEADER` followed by a sealed payload. Stream 0
+    carries the HELLO with the connection secret; clients open odd streams.
+    """
+
+    def __init__(
+        self,
+        send: Callable[[bytes], Awaitable[None]],
+        secret: str,
+        window: int,
+        max_streams: int,
+        accept_streams: bool = False,
+    ):
+        self.secret = secret
+        self.window = window
+        self.max_streams = max_streams
+        self.accept_streams = accept_streams
+        self.closed = False
+        self.on_release: Callable[[MuxStream], None] | None = None
+        self._send_message = send
+        self._send_lock = asyncio.Lock()
+        self._streams: dict[int, MuxStream] = {}
+        self._next_id = 1
+
+    def __len__(self) -> int:
+        return len(self._streams)
+
+    def stream_secret(self, stream_id: int, from_client: bool) -> str:
+        """Secret of one direction of a stream, derived from the connection's."""
+        label = f"{stream_id}:{'c' if from_client else 's'}".encode()
+        digest = hmac.new(self.secret.encode(), label, hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest).decode()
+
+    def hello(self, shared_secret: str) -> bytes:
+        """HELLO message telling the peer the connection secret and window."""
+        payload = json.dumps({"s": self.secret, "w": self.window}).encode()
+        sealed = Potato(shared_secret).pack_bytes(payload)
+        return MUX_HEADER.pack(0, FrameType.HELLO) + sealed
+
+    @classmethod
+    def from_hello(
+        cls,
+        message: bytes,
+        shared_secret: str,
+        send: Callable[[bytes], Awaitable[None]],
+        max_streams: int,
+    ) -> "MuxConnection":
+        """Accept a connection, adopting the secret and window of its HELLO."""
+        stream_id, kind = MUX_HEADER.unpack_from(message)
+        if stream_id != 0 or kind != FrameType.HELLO:
+            raise ValueError("expected a HELLO message")
+        sealed = message[MUX_HEADER.size :]
+        hello = json.loads(Potato(shared_secret).unpack_bytes(sealed))
+        return cls(send, hello["s"], hello["w"], max_streams, accept_streams=True)
+
+    async def _send(self, stream_id: int, kind: FrameType, payload: bytes) -> None:
+        if self.closed:
+            raise StreamReset("connection closed")
+        async with self._send_lock:
+            await self._send_message(MUX_HEADER.pack(stream_id, kind) + payload)
+
+    def _release(self, stream: MuxStream) -> None:
+        if self._streams.pop(stream.id, None) is not None and self.on_release:
+            self.on_release(stream)
+
+    def open_stream(self) -> MuxStream:
+        if self.closed or len(self._streams) >= self.max_streams:
+            raise StreamReset("connection cannot take more streams")
+
+        stream = MuxStream(self, self._next_id)
+        self._next_id += 2
+        self._streams[stream.id] = stream
+        return stream
+
+    async def feed(self, message: bytes) -> MuxStream | None:
+        """Dispatch one incoming message, returning a stream the peer opened."""
+        stream_id, kind = MUX_HEADER.unpack_from(message)
+        payload = message[MUX_HEADER.size :]
+
+        stream = self._streams.get(stream_id)
+        if stream is not None:
+            stream._deliver(FrameType(kind), payload)
+            return None
+
+        if not self.accept_streams or kind != FrameType.HEADER:
+            return None  # late frame of a stream that is already released
+        if len(self._streams) >= self.max_streams:
+            secret = self.stream_secret(stream_id, from_client=False)
+            sealed = Potato(secret).pack_bytes(b"too many streams")
+            await self._send(stream_id, FrameType.ERROR, sealed)
+            return None
+
+        stream = MuxStream(self, stream_id)
+        self._streams[stream_id] = stream
+        stream._deliver(FrameType(kind), payload)
+        return stream
+
+    def close(self, reason: str = "connection closed") -> None:
+        self.closed = True
+        for stream in list(self._streams.values()):
+            stream._fail(reason)
+
+
+class MuxClient(object):
+    """Up to `connections` persistent WebSocket connections to castor.
+
+    Streams go to the least busy live connection; a connection that drops
+    fails its streams and is replaced on demand, backing off while castor
+    is unreachable.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        shared_secret: str,
+        connections: int,
+        max_streams: int,
+        window: int,
+        max_backoff: float,
+    ):
+        self.url = url
+        self.shared_secret = shared_secret
+        self.connections = connections
+        self.max_streams = max_streams
+        self.window = window
+        self.max_backoff = max_backoff
+        self._conns: list[MuxConnection] = []
+        self._readers: set[asyncio.Task[None]] = set()
+        self._slots = asyncio.Semaphore(connections * max_streams)
+        self._connecting: asyncio.Task[MuxConnection] | None = None
+        self._failures = 0
+
+    async def open_stream(self) -> MuxStream:
+        await self._slots.acquire()
+        try:
+            while True:
+                conns = [c for c in self._conns if len(c) < c.max_streams]
+                if conns:
+                    return min(conns, key=len).open_stream()
+                # streams waiting for a connection share one attempt at it
+                if self._connecting is None:
+                    self._connecting = asyncio.create_task(self._connect())
+                    self._connecting.add_done_callback(self._connected)
+                await asyncio.shield(self._connecting)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _connected(self, task: asyncio.Task[MuxConnection]) -> None:
+        self._connecting = None
+        if not task.cancelled():
+            task.exception()  # retrieved, in case every waiter gave up
+
+    async def _connect(self) -> MuxConnection:
+        if self._failures:
+            await asyncio.sleep(min(self.max_backoff, 0.1 * 2**self._failures))
+
+        try:
+            ws = await websockets.connect(self.url, max_size=None)
+        except (OSError, websockets.WebSocketException) as e:
+            self._failures += 1
+            raise StreamReset(f"cannot connect to {self.url}: {e!r}") from e
+        self._failures = 0
+
+        secret = secrets.token_urlsafe(24)
+        conn = MuxConnection(ws.send, secret, self.window, self.max_streams)
+        conn.on_release = lambda stream: self._slots.release()
+        await ws.send(conn.hello(self.shared_secret))
+        self._conns.append(conn)
+
+        reader = asyncio.create_task(self._read(ws, conn))
+        self._readers.add(reader)
+        reader.add_done_callback(self._readers.discard)
+        logger.info("Mux Connected - %s (%s connections)", self.url, len(self._conns))
+        return conn
+
+    async def _read(
+        self, ws: websockets.ClientConnection, conn: MuxConnection
+    ) -> None:
+        try:
+            async for message in ws:
+                if isinstance(message, bytes):
+                    await conn.feed(message)
+        except websockets.ConnectionClosed as e:
+            logger.warning("Mux Disconnected - %r", e)
+        finally:
+            self._conns.remove(conn)
+            conn.close()
+            await ws.close()
+
+    async def aclose(self) -> None:
+        for reader in list(self._readers):
+            reader.cancel()
+        await asyncio.gather(*self._readers, return_exceptions=True)
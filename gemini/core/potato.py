@@ -1,18 +1,39 @@
 import binascii
-from itertools import cycle
+import time
+from functools import lru_cache
+
+from gemini.metrics import cipher_bytes, cipher_seconds
 
 BASE64_TABLE = b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
 I2B = dict(enumerate(BASE64_TABLE))
 B2I = dict((b, i) for i, b in enumerate(BASE64_TABLE))
 
 
+def _shift_table(shift: int) -> bytes:
+    # bytes.translate table rotating the base64 alphabet by `shift` positions
+    table = bytearray(range(256))
+    for b, i in B2I.items():
+        table[b] = I2B[(i + shift) % 64]
+    return bytes(table)
+
+
+ENCRYPT_TABLES = tuple(_shift_table(shift) for shift in range(64))
+DECRYPT_TABLES = tuple(_shift_table(-shift) for shift in range(64))
+
+
+@lru_cache(maxsize=1024)
+def key_schedule(key: str) -> tuple[int, ...]:
+    """Alphabet index of every base64 char of `key`, cached per secret."""
+    return tuple(B2I[k] for k in Potato.base64_encode(key.encode()))
+
+
 class Potato(object):
     def __init__(self, key: str):
-        self._key = self.base64_encode(key.encode())
-        self._ck = cycle(self._key)
+        self._shifts = key_schedule(key)
+        self._offset = 0
 
     @staticmethod
-    def base64_encode(data: bytes) -> bytes:
+    def base64_encode(data: bytes | memoryview) -> bytes:
         padding = -len(data) % 3
         r = binascii.b2a_base64(data, newline=False)
         if padding:
@@ -25,13 +46,44 @@ class Potato(object):
         d = data + b"=" * padding
         return binascii.a2b_base64(d.decode())
 
+    def _crypt(self, data: bytes, tables: tuple[bytes, ...], skip: int = 1) -> bytes:
+        started = time.perf_counter()
+        op = "encrypt" if tables is ENCRYPT_TABLES else "decrypt"
+        try:
+            return self._translate(data, tables, skip)
+        finally:
+            cipher_seconds.inc(op, amount=time.perf_counter() - started)
+            cipher_bytes.inc(op, amount=len(data))
+
+    def _translate(
+        self, data: bytes, tables: tuple[bytes, ...], skip: int = 1,
+    ) -> bytes:
+        # Every `size`-th byte shares one key char, so a chunk is processed
+        # with one strided translate per key position instead of per byte.
+        shifts = self._shifts
+        size = len(shifts)
+        if not size:
+            return b""
+        if data.translate(None, BASE64_TABLE):
+            raise ValueError("data contains non-base64 characters")
+
+        offset = self._offset
+        out = bytearray(len(data))
+        for j in range(min(size, len(data))):
+            out[j::size] = data[j::size].translate(tables[shifts[(offset + j) % size]])
+
+        # Each message consumes one key char past the end of data, as
+        # `zip(cycle(key), data)` does; the wire format depends on it.
+        self._offset = (offset + len(data) + skip) % size
+        return bytes(out)
+
     def encrypt(self, data: bytes) -> bytes:
-        return bytes(I2B[(B2I[d] + B2I[k]) % 64] for k, d in zip(self._ck, data))
+        return self._crypt(data, ENCRYPT_TABLES)
 
     def decrypt(self, data: bytes) -> bytes:
-        return bytes(I2B[(64 + B2I[d] - B2I[k]) % 64] for k, d in zip(self._ck, data))
+        return self._crypt(data, DECRYPT_TABLES)
 
-    def pack_bytes(self, data: bytes) -> bytes:
+    def pack_bytes(self, data: bytes | memoryview) -> bytes:
         return self.encrypt(self.base64_encode(data))
 
     def pack_str(self, data: str) -> str:
@@ -44,4 +96,76 @@ class Potato(object):
         return self.unpack_bytes(data.encode()).decode()
 
     def reset(self) -> None:
-        self._ck = cycle(self._key)
+        self._offset = 0
+
+
+class PotatoEncoder(object):
+    """Incremental `Potato.pack_bytes` over a stream of arbitrary chunks.
+
+    The key and the base64 quantum run continuously across `update` calls,
+    so the concatenated output only depends on the concatenated input.
+    """
+
+    def __init__(self, key: str):
+        self._potato = Potato(key)
+        self._pending = bytearray()
+
+    def update(self, data: bytes) -> bytes:
+        view = memoryview(data)
+        pending = self._pending
+        head = b""
+        if pending:
+            need = 3 - len(pending)
+            pending += view[:need]
+            view = view[need:]
+            if len(pending) < 3:
+                return b""
+            head = binascii.b2a_base64(pending, newline=False)
+            pending.clear()
+
+        size = len(view) - len(view) % 3
+        pending += view[size:]
+        encoded = binascii.b2a_base64(view[:size], newline=False) if size else b""
+        if head:
+            encoded = head + encoded
+        return self._potato._crypt(encoded, ENCRYPT_TABLES, skip=0)
+
+    def flush(self) -> bytes:
+        encoded = Potato.base64_encode(bytes(self._pending))
+        self._pending.clear()
+        return self._potato._crypt(encoded, ENCRYPT_TABLES, skip=0)
+
+
+class PotatoDecoder(object):
+    """Incremental `Potato.unpack_bytes` for `PotatoEncoder` streams."""
+
+    def __init__(self, key: str):
+        self._potato = Potato(key)
+        self._pending = bytearray()
+
+    def update(self, data: bytes) -> bytes:
+        view = memoryview(self._potato._crypt(data, DECRYPT_TABLES, skip=0))
+        pending = self._pending
+        head = b""
+        if pending:
+            need = 4 - len(pending)
+            pending += view[:need]
+            view = view[need:]
+            if len(pending) < 4:
+                return b""
+            head = binascii.a2b_base64(pending)
+            pending.clear()
+
+        size = len(view) - len(view) % 4
+        pending += view[size:]
+        decoded = binascii.a2b_base64(view[:size]) if size else b""
+        if head:
+            decoded = head + decoded
+        return decoded
+
+    def flush(self) -> bytes:
+        if len(self._pending) % 4 == 1:
+            raise ValueError("truncated potato stream")
+        decoded = Potato.base64_decode(bytes(self._pending))
+        self._pending.clear()
+        return decoded
@@ -0,0 +1,156 @@
+"""Download a large upstream body over several connections at once.
+
+When the upstream takes byte ranges for a response, the rest of its body is
+fetched as fixed-size segments, a few at a time, while the first segment
+streams from the original response. Segments are yielded strictly in order,
+so at most `concurrency` of them are held in memory.
+"""
+import asyncio
+from collections import deque
+from typing import AsyncIterator
+
+import httpx
+
+from gemini.metrics import ranged_downloads
+
+RETRIES = 1
+
+
+class RangeError(Exception):
+    pass
+
+
+def range_validator(resp: httpx.Response) -> str | None:
+    """The `If-Range` value that pins segments to this very representation."""
+    etag = resp.headers.get("etag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return resp.headers.get("last-modified")
+
+
+def ranged_size(request: httpx.Request, resp: httpx.Response, min_size: int) -> int:
+    """Body size if `resp` may be fetched in ranges, otherwise 0."""
+    length = resp.headers.get("content-length", "")
+    if (
+        request.method != "GET"
+        or "range" in request.headers
+        or resp.status_code != 200
+        or "bytes" not in resp.headers.get("accept-ranges", "").lower()
+        # encoded on the fly, ranges of it need not line up
+        or resp.headers.get("content-encoding", "identity") != "identity"
+        or not length.isdigit()
+        or range_validator(resp) is None
+    ):
+        return 0
+    return int(length) if int(length) >= min_size else 0
+
+
+class RangedStream(httpx.AsyncByteStream):
+    def __init__(
+        self,
+        client: httpx.AsyncClient,
+        request: httpx.Request,
+        first: httpx.Response,
+        size: int,
+        segment_size: int,
+        concurrency: int,
+    ):
+        self.client = client
+        self.request = request
+        self.first = first
+        self.size = size
+        self.segment_size = segment_size
+        self.concurrency = concurrency
+        self.validator = range_validator(first) or ""
+        self.segments: deque[asyncio.Task[bytes]] = deque()
+
+    async def fetch(self, start: int) -> bytes:
+        end = min(start + self.segment_size, self.size)
+        headers = self.request.headers.copy()
+        headers["range"] = f"bytes={start}-{end - 1}"
+        headers["if-range"] = self.validator
+        attempt = 0
+        while True:
+            try:
+                resp = await self.client.get(self.request.url, headers=headers)
+                content_range = resp.headers.get("content-range", "")
+                if (
+                    resp.status_code != 206
+                    or not content_range.startswith(f"bytes {start}-{end - 1}/")
+                    or len(resp.content) != end - start
+                ):
+                    raise RangeError(
+                        f"bad segment {start}-{end - 1}: {resp.status_code} "
+                        f"{content_range!r} {len(resp.content)} bytes"
+                    )
+                return resp.content
+            except (httpx.HTTPError, RangeError):
+                if attempt >= RETRIES:
+                    ranged_downloads.inc("failed")
+                    raise
+                ranged_downloads.inc("retried")
+                attempt += 1
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        starts = iter(range(self.segment_size, self.size, self.segment_size))
+        segments = self.segments
+
+        def schedule() -> None:
+            if (start := next(starts, None)) is not None:
+                segments.append(asyncio.create_task(self.fetch(start)))
+
+        try:
+            for _ in range(self.concurrency):
+                schedule()
+
+            # the first segment comes from the response at hand
+            sent = 0
+            async for chunk in self.first.aiter_raw():
+                chunk = chunk[: self.segment_size - sent]
+                sent += len(chunk)
+                yield chunk
+                if sent >= self.segment_size:
+                    break
+            await self.first.aclose()
+            if sent != min(self.segment_size, self.size):
+                raise RangeError(f"first segment ended after {sent} bytes")
+
+            while segments:
+                data = await segments.popleft()
+                schedule()
+                yield data
+        finally:
+            await self.aclose()
+
+    async def aclose(self) -> None:
+        # also when the response is closed before the body was read out
+        segments = list(self.segments)
+        self.segments.clear()
+        for task in segments:
+            task.cancel()
+        await asyncio.gather(*segments, return_exceptions=True)
+        await self.first.aclose()
+
+
+def ranged_response(
+    client: httpx.AsyncClient,
+    request: httpx.Request,
+    resp: httpx.Response,
+    segment_size: int,
+    concurrency: int,
+    min_size: int,
+) -> httpx.Response:
+    """`resp`, with its body fetched in parallel ranges if the upstream allows."""
+    size = ranged_size(request, resp, max(min_size, segment_size + 1))
+    if not size:
+        return resp
+
+    ranged_downloads.inc("ranged")
+    stream = RangedStream(client, request, resp, size, segment_size, concurrency)
+    return httpx.Response(
+        resp.status_code,
+        headers=resp.headers.multi_items(),
+        stream=stream,
+        request=request,
+        extensions=resp.extensions,
+    )
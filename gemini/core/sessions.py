@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import NamedTuple
+
+import httpx
+
+from gemini.core.events import wait_for_event
+from gemini.core.potato import Potato
+
+logger = logging.getLogger("gemini.sessions")
+
+MAX_BATCH = 100  # castor's limit for `/hello?k=`
+
+
+class TunnelSession(NamedTuple):
+    id: str
+    secret: str
+    deadline: float  # `time.monotonic()` at which castor expires it
+
+
+async def ask_sessions(
+    client: httpx.AsyncClient, url_base: str, shared_secret: str, count: int,
+) -> list[TunnelSession]:
+    """Ask castor for `count` new sessions with one `/hello` call."""
+    started = time.monotonic()
+    resp = await client.get(f"{url_base}/hello", params={"k": count})
+    resp.raise_for_status()
+
+    potato = Potato(shared_secret)
+    sessions: list[TunnelSession] = []
+    for item in resp.json()["data"]:
+        potato.reset()
+        secret = potato.unpack_str(item["data"])
+        sessions.append(TunnelSession(item["token"], secret, started + item["e"]))
+    return sessions
+
+
+class SessionPool(object):
+    """Sessions asked from castor ahead of time, so requests skip `/hello`.
+
+    A background task keeps up to `size` sessions ready, topping the pool up
+    whenever a session is taken and at least every `refill_interval` seconds.
+    Sessions within `margin` seconds of their expiry are discarded, and an
+    empty pool falls back to asking castor directly.
+    """
+
+    def __init__(
+        self,
+        client: httpx.AsyncClient,
+        url_base: str,
+        shared_secret: str,
+        size: int,
+        refill_interval: float,
+        margin: float,
+    ):
+        self.client = client
+        self.url_base = url_base
+        self.shared_secret = shared_secret
+        self.size = size
+        self.refill_interval = refill_interval
+        self.margin = margin
+        self.hits = 0
+        self.misses = 0
+        self._sessions: deque[TunnelSession] = deque()
+        self._wanted = asyncio.Event()
+        self._task: asyncio.Task[None] | None = None
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def _fresh(self, session: TunnelSession, now: float) -> bool:
+        return session.deadline - self.margin > now
+
+    async def get(self) -> TunnelSession:
+        now = time.monotonic()
+        session: TunnelSession | None = None
+        while self._sessions:
+            session = self._sessions.popleft()
+            if self._fresh(session, now):
+                break
+            session = None
+
+        self.start()
+        if session is not None:
+            self.hits += 1
+            return session
+
+        self.misses += 1
+        (session,) = await ask_sessions(
+            self.client, self.url_base, self.shared_secret, 1
+        )
+        return session
+
+    def start(self) -> None:
+        """Start (or wake up) the refill task."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._refill())
+        self._wanted.set()
+
+    async def _refill(self) -> None:
+        while True:
+            now = time.monotonic()
+            while self._sessions and not self._fresh(self._sessions[0], now):
+                self._sessions.popleft()
+
+            self._wanted.clear()
+            missing = self.size - len(self._sessions)
+            if missing > 0:
+                try:
+                    self._sessions += await ask_sessions(
+                        self.client,
+                        self.url_base,
+                        self.shared_secret,
+                        min(missing, MAX_BATCH),
+                    )
+                except (httpx.HTTPError, KeyError, ValueError) as e:
+                    logger.warning("Session Pool Refill Failed - %r", e)
+                    self._wanted.clear()  # retry after `refill_interval`
+
+            await wait_for_event(self._wanted, self.refill_interval)
+
+    async def aclose(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
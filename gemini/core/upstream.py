@@ -0,0 +1,371 @@
+"""castor's long-lived connections to upstream hosts.
+
+Every origin gets a connection pool of its own, so one busy host cannot
+take all connections, and pools of hosts not seen for a while are closed
+once they are idle. Connections are opened through a network backend that
+caches DNS answers and counts TCP and TLS handshakes.
+"""
+import asyncio
+import ipaddress
+import socket
+import time
+import urllib.request
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial
+from typing import Any, AsyncIterable, AsyncIterator, Iterable, Iterator
+
+import httpcore
+import httpx
+
+from gemini.metrics import dns_lookups, upstream_handshakes
+
+Origin = tuple[bytes, bytes, int | None]
+Addresses = asyncio.Future[list[str]]
+
+# httpx raises its own exceptions, most specific httpcore class first
+HTTPCORE_EXCEPTIONS: dict[type[Exception], type[httpx.TransportError]] = {
+    httpcore.ConnectTimeout: httpx.ConnectTimeout,
+    httpcore.ReadTimeout: httpx.ReadTimeout,
+    httpcore.WriteTimeout: httpx.WriteTimeout,
+    httpcore.PoolTimeout: httpx.PoolTimeout,
+    httpcore.TimeoutException: httpx.TimeoutException,
+    httpcore.ConnectError: httpx.ConnectError,
+    httpcore.ReadError: httpx.ReadError,
+    httpcore.WriteError: httpx.WriteError,
+    httpcore.NetworkError: httpx.NetworkError,
+    httpcore.ProxyError: httpx.ProxyError,
+    httpcore.UnsupportedProtocol: httpx.UnsupportedProtocol,
+    httpcore.LocalProtocolError: httpx.LocalProtocolError,
+    httpcore.RemoteProtocolError: httpx.RemoteProtocolError,
+    httpcore.ProtocolError: httpx.ProtocolError,
+}
+
+
+class DNSCache(object):
+    """Addresses by host and port, kept for `ttl` seconds.
+
+    `getaddrinfo` tells nothing about record TTLs, so one TTL holds for all.
+    Concurrent lookups of a name share one resolution.
+    """
+
+    def __init__(self, ttl: float, max_entries: int = 4096):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # (host, port) -> (expires at, addresses)
+        self._entries: dict[tuple[str, int], tuple[float, Addresses]] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def resolve(self, host: str, port: int) -> list[str]:
+        key = (host, port)
+        now = time.monotonic()
+        expires, addresses = self._entries.get(key, (0.0, None))
+        if addresses is not None and now < expires:
+            dns_lookups.inc("hit")
+            return await asyncio.shield(addresses)
+
+        dns_lookups.inc("miss")
+        if len(self._entries) >= self.max_entries:
+            self._prune(now)
+        addresses = asyncio.ensure_future(self._lookup(host, port))
+        addresses.add_done_callback(partial(self._forget_failed, key))
+        self._entries[key] = (now + self.ttl, addresses)
+        return await asyncio.shield(addresses)
+
+    async def _lookup(self, host: str, port: int) -> list[str]:
+        infos = await asyncio.get_running_loop().getaddrinfo(
+            host, port, type=socket.SOCK_STREAM
+        )
+        return list(dict.fromkeys(str(info[4][0]) for info in infos))
+
+    def _forget_failed(self, key: tuple[str, int], addresses: Addresses) -> None:
+        # also when every caller gave up waiting, so failures are not cached
+        if addresses.cancelled() or addresses.exception() is not None:
+            dns_lookups.inc("failed")
+            if self._entries.get(key, (0.0, None))[1] is addresses:
+                del self._entries[key]
+
+    def _prune(self, now: float) -> None:
+        for key, (expires, _) in list(self._entries.items()):
+            if expires <= now:
+                del self._entries[key]
+        while len(self._entries) >= self.max_entries:
+            del self._entries[next(iter(self._entries))]
+
+
+def _is_address(host: str) -> bool:
+    try:
+        ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return True
+
+
+class CountingStream(httpcore.AsyncNetworkStream):
+    def __init__(self, stream: httpcore.AsyncNetworkStream):
+        self.stream = stream
+
+    async def read(self, max_bytes: int, timeout: float | None = None) -> bytes:
+        return await self.stream.read(max_bytes, timeout)
+
+    async def write(self, buffer: bytes, timeout: float | None = None) -> None:
+        await self.stream.write(buffer, timeout)
+
+    async def aclose(self) -> None:
+        await self.stream.aclose()
+
+    async def start_tls(
+        self,
+        ssl_context: Any,
+        server_hostname: str | None = None,
+        timeout: float | None = None,
+    ) -> httpcore.AsyncNetworkStream:
+        stream = await self.stream.start_tls(ssl_context, server_hostname, timeout)
+        upstream_handshakes.inc("tls")
+        return stream
+
+    def get_extra_info(self, info: str) -> Any:
+        return self.stream.get_extra_info(info)
+
+
+class UpstreamBackend(httpcore.AsyncNetworkBackend):
+    """httpcore's default backend, resolving names through a `DNSCache`.
+
+    The addresses of a name are tried in order. TLS still verifies and sends
+    SNI for the name, which httpcore passes on separately.
+    """
+
+    def __init__(self, dns: DNSCache | None):
+        self.dns = dns
+        self.backend = httpcore.AnyIOBackend()
+
+    async def connect_tcp(
+        self,
+        host: str,
+        port: int,
+        timeout: float | None = None,
+        local_address: str | None = None,
+        socket_options: Iterable[Any] | None = None,
+    ) -> httpcore.AsyncNetworkStream:
+        addresses = [host]
+        if self.dns is not None and not _is_address(host):
+            try:
+                addresses = await asyncio.wait_for(
+                    self.dns.resolve(host, port), timeout
+                )
+            except asyncio.TimeoutError:
+                raise httpcore.ConnectTimeout(f"resolving {host!r} timed out")
+            except OSError as e:
+                raise httpcore.ConnectError(f"resolving {host!r}: {e}") from e
+
+        error: Exception | None = None
+        for address in addresses:
+            try:
+                stream = await self.backend.connect_tcp(
+                    address,
+                    port,
+                    timeout=timeout,
+                    local_address=local_address,
+                    socket_options=socket_options,
+                )
+            except (httpcore.ConnectError, httpcore.ConnectTimeout) as e:
+                error = e
+                continue
+            upstream_handshakes.inc("tcp")
+            return CountingStream(stream)
+        assert error is not None
+        raise error
+
+    async def connect_unix_socket(
+        self,
+        path: str,
+        timeout: float | None = None,
+        socket_options: Iterable[Any] | None = None,
+    ) -> httpcore.AsyncNetworkStream:
+        return await self.backend.connect_unix_socket(path, timeout, socket_options)
+
+    async def sleep(self, seconds: float) -> None:
+        await self.backend.sleep(seconds)
+
+
+def environment_proxies() -> dict[str, str | None]:
+    """httpx mounts for the `*_proxy` environment variables.
+
+    Hosts in `no_proxy` map to None; a `*` there turns proxies off.
+    """
+    env = urllib.request.getproxies()
+    proxies: dict[str, str | None] = {}
+    for scheme in ("http", "https", "all"):
+        if url := env.get(scheme):
+            proxies[f"{scheme}://"] = url if "://" in url else f"http://{url}"
+
+    for host in (h.strip() for h in env.get("no", "").split(",")):
+        if host == "*":
+            return {}
+        address = host.strip("[]")
+        if "://" in host:
+            proxies[host] = None
+        elif _is_address(address):
+            pattern = f"[{address}]" if ":" in address else address
+            proxies[f"all://{pattern}"] = None
+        elif host == "localhost":
+            proxies["all://localhost"] = None
+        elif host:
+            # the host itself and its subdomains
+            proxies[f"all://*{host.lstrip('.')}"] = None
+    return proxies
+
+
+@contextmanager
+def httpx_exceptions() -> Iterator[None]:
+    try:
+        yield
+    except Exception as e:
+        for cls in type(e).__mro__:
+            if cls in HTTPCORE_EXCEPTIONS:
+                raise HTTPCORE_EXCEPTIONS[cls](str(e)) from e
+        raise
+
+
+class PoolStream(httpx.AsyncByteStream):
+    """An httpcore response body, counting as in flight on its pool until closed."""
+
+    def __init__(self, stream: AsyncIterable[bytes], pool: "OriginPool"):
+        self.stream = stream
+        self.pool: OriginPool | None = pool
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        with httpx_exceptions():
+            async for chunk in self.stream:
+                yield chunk
+
+    async def aclose(self) -> None:
+        if self.pool is not None:
+            self.pool.requests -= 1
+            self.pool = None
+        if hasattr(self.stream, "aclose"):
+            with httpx_exceptions():
+                await self.stream.aclose()
+
+
+class OriginPool(httpx.AsyncBaseTransport):
+    """httpx transport over the httpcore pool of one origin.
+
+    httpx takes no network backend, so the pool is made and driven here.
+    """
+
+    def __init__(self, pool: httpcore.AsyncConnectionPool):
+        self.pool = pool
+        self.requests = 0  # in flight, bodies included
+
+    @property
+    def connections(self) -> list[Any]:
+        return list(self.pool.connections)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        assert isinstance(request.stream, httpx.AsyncByteStream)
+        core_request = httpcore.Request(
+            method=request.method,
+            url=httpcore.URL(
+                scheme=request.url.raw_scheme,
+                host=request.url.raw_host,
+                port=request.url.port,
+                target=request.url.raw_path,
+            ),
+            headers=request.headers.raw,
+            content=request.stream,
+            extensions=request.extensions,
+        )
+        with httpx_exceptions():
+            resp = await self.pool.handle_async_request(core_request)
+
+        assert isinstance(resp.stream, AsyncIterable)
+        return httpx.Response(
+            status_code=resp.status,
+            headers=resp.headers,
+            stream=PoolStream(resp.stream, self),
+            extensions=resp.extensions,
+        )
+
+    async def aclose(self) -> None:
+        await self.pool.aclose()
+
+
+class UpstreamTransport(httpx.AsyncBaseTransport):
+    """One connection pool per origin, at most `max_hosts` of them kept.
+
+    Past `max_hosts`, the least recently used pools without requests in
+    flight are closed.
+    """
+
+    def __init__(
+        self,
+        limits: httpx.Limits,
+        http2: bool = False,
+        dns_ttl: float = 0.0,
+        max_hosts: int = 256,
+        trust_env: bool = True,
+    ):
+        self.limits = limits
+        self.http2 = http2
+        self.max_hosts = max_hosts
+        self.dns = DNSCache(dns_ttl) if dns_ttl > 0 else None
+        self.backend = UpstreamBackend(self.dns)
+        self.ssl_context = httpx.create_ssl_context(trust_env=trust_env)
+        self._pools: OrderedDict[Origin, OriginPool] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._pools)
+
+    def _new_pool(self) -> OriginPool:
+        pool = httpcore.AsyncConnectionPool(
+            ssl_context=self.ssl_context,
+            max_connections=self.limits.max_connections,
+            max_keepalive_connections=self.limits.max_keepalive_connections,
+            keepalive_expiry=self.limits.keepalive_expiry,
+            http2=self.http2,
+            network_backend=self.backend,
+        )
+        return OriginPool(pool)
+
+    def _acquire(self, url: httpx.URL) -> tuple[OriginPool, list[OriginPool]]:
+        """The pool for `url` with a request counted on it, and pools to close."""
+        origin = (url.raw_scheme, url.raw_host, url.port)
+        pool = self._pools.get(origin)
+        if pool is None:
+            pool = self._pools[origin] = self._new_pool()
+        self._pools.move_to_end(origin)
+        pool.requests += 1  # before evicting, so it is not evicted itself
+
+        idle = [key for key, old in self._pools.items() if not old.requests]
+        evicted = [self._pools.pop(key) for key in idle[: len(self) - self.max_hosts]]
+        return pool, evicted
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        pool, evicted = self._acquire(request.url)
+        try:
+            for old in evicted:
+                await old.aclose()
+            return await pool.handle_async_request(request)
+        except BaseException:
+            pool.requests -= 1
+            raise
+
+    async def aclose(self) -> None:
+        pools = list(self._pools.values())
+        self._pools.clear()
+        for pool in pools:
+            await pool.aclose()
+
+    def stats(self) -> dict[str, int]:
+        connections = [c for pool in self._pools.values() for c in pool.connections]
+        return {
+            "hosts": len(self._pools),
+            "requests": sum(pool.requests for pool in self._pools.values()),
+            "connections": len(connections),
+            "idle": sum(1 for conn in connections if conn.is_idle()),
+            "http2": sum(1 for c in connections if c.info().startswith("HTTP/2")),
+            "dns_entries": len(self.dns) if self.dns is not None else 0,
+        }
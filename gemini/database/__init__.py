@@ -1,17 +1,25 @@
+import asyncio
 import logging
+import time
 from contextlib import asynccontextmanager
 from typing import Any, AsyncGenerator
 
+from sqlalchemy import delete, event, func, inspect, select, text
 from sqlalchemy.ext.asyncio.engine import AsyncEngine as Engine
 from sqlalchemy.ext.asyncio.engine import create_async_engine
 from sqlalchemy.ext.asyncio.session import AsyncSession as Session
 
 from gemini.config import config
+from gemini.metrics import db_query_seconds
 
 from ._base import Base
+from .memory import MemoryStorage
+from .storage import SQLStorage, Storage, StorageFull
 from .tables import *  # noqa
 
 engine: Engine = None
+memory_storage: MemoryStorage | None = None
+shared_connection_lock = asyncio.Lock()
 logger = logging.getLogger("gemini.database")
 
 
@@ -29,10 +37,50 @@ def get_engine() -> Engine:
         engine = create_async_engine(
             config.db_url, connect_args=connect_args, future=True,
         )
+        if config.db_url.startswith("sqlite") and not shares_one_connection():
+            event.listen(engine.sync_engine, "connect", set_sqlite_pragmas)
+        event.listen(engine.sync_engine, "before_cursor_execute", start_query_timer)
+        event.listen(engine.sync_engine, "after_cursor_execute", stop_query_timer)
 
     return engine
 
 
+def shares_one_connection() -> bool:
+    # an in-memory SQLite database lives in a single, shared connection
+    return config.db_url.startswith("sqlite") and ":memory:" in config.db_url
+
+
+def start_query_timer(conn: Any, cursor: Any, statement: str, *args: Any) -> None:
+    conn.info["query_started"] = time.perf_counter()
+
+
+def stop_query_timer(conn: Any, cursor: Any, statement: str, *args: Any) -> None:
+    elapsed = time.perf_counter() - conn.info["query_started"]
+    kind = statement.lstrip().split(None, 1)[0].upper() if statement else ""
+    db_query_seconds.observe(kind, value=elapsed)
+
+
+def set_sqlite_pragmas(dbapi_connection: Any, connection_record: Any) -> None:
+    # WAL lets readers in every worker run alongside the single writer, and
+    # busy_timeout makes writers queue instead of failing with "locked".
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={int(config.sqlite_busy_timeout * 1000)}")
+    cursor.close()
+
+
+def shared_state_error(workers: int) -> str | None:
+    """Why castor's storage cannot be shared by `workers` processes, if so."""
+    if workers <= 1:
+        return None
+    if config.storage_backend == "memory":
+        return "storage_backend=memory is private to each worker"
+    if shares_one_connection():
+        return "an in-memory SQLite database is private to each worker"
+    return None
+
+
 async def get_session(
     autocommit: bool = False, autoflush: bool = False,
 ) -> AsyncGenerator[Session, None]:
@@ -56,6 +104,30 @@ async def get_session(
 scoped_session = asynccontextmanager(get_session)
 
 
+def get_memory_storage() -> MemoryStorage:
+    global memory_storage
+
+    if memory_storage is None:
+        memory_storage = MemoryStorage(
+            max_sessions=config.memory_max_sessions,
+            max_bytes=config.memory_max_bytes,
+        )
+
+    return memory_storage
+
+
+async def get_storage() -> AsyncGenerator[Storage, None]:
+    if config.storage_backend == "memory":
+        yield get_memory_storage()
+    else:
+        async with scoped_session() as db_session:
+            lock = shared_connection_lock if shares_one_connection() else None
+            yield SQLStorage(db_session, lock)
+
+
+scoped_storage = asynccontextmanager(get_storage)
+
+
 async def init_db(drop: bool = False) -> None:
     engine = get_engine()
 
@@ -63,3 +135,38 @@ async def init_db(drop: bool = False) -> None:
         if drop:
             await conn.run_sync(Base.metadata.drop_all)
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(create_indexes)
+
+
+def create_indexes(conn: Any) -> None:
+    # `create_all` skips tables that exist, so older databases need their
+    # indexes added one by one.
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            if index.unique:
+                drop_duplicates(conn, table, index)
+            index.create(conn)
+
+    # replaced by the unique ux_request_body_session_id_index
+    if "ix_request_body_session_id_index" in {
+        index["name"] for index in inspector.get_indexes("request_body")
+    }:
+        conn.execute(text("DROP INDEX ix_request_body_session_id_index"))
+
+
+def drop_duplicates(conn: Any, table: Any, index: Any) -> None:
+    """Keep only the newest row of each key of a unique index yet to be made."""
+    (pk,) = table.primary_key.columns
+    newest = select(func.max(pk)).group_by(*index.columns)
+    result = conn.execute(delete(table).where(pk.not_in(newest)))
+    if result.rowcount:
+        logger.warning(
+            "Dropped %s duplicate %s rows to create %s",
+            result.rowcount,
+            table.name,
+            index.name,
+        )
@@ -1,27 +1,46 @@
 import secrets
 import string
 from datetime import datetime, timedelta
+from typing import Any, AsyncGenerator
 from uuid import uuid4
 
 from sqlalchemy.ext.asyncio.session import AsyncSession as Session
 from sqlalchemy.sql.expression import delete, select
 
+from gemini.config import config
+
 from .tables import RequestBody, RequestHeader, RequestSession, ResponseHeader
 
+UPSERT_BATCH_SIZE = 500  # rows per statement, well under SQLite's bind limit
 
-async def create_request_session(db_session: Session) -> RequestSession:
+
+def new_request_session() -> RequestSession:
     charts = string.ascii_letters + string.digits
-    req_session = RequestSession(
+    return RequestSession(
         id=str(uuid4()),
         secret="".join(secrets.choice(charts) for _ in range(32)),
-        exp=datetime.now() + timedelta(days=1),
+        exp=datetime.now() + timedelta(seconds=config.session_ttl),
     )
 
+
+async def create_request_session(db_session: Session) -> RequestSession:
+    req_session = new_request_session()
+
     db_session.add(req_session)
     await db_session.commit()
     return req_session
 
 
+async def create_request_sessions(
+    db_session: Session, count: int,
+) -> list[RequestSession]:
+    req_sessions = [new_request_session() for _ in range(count)]
+
+    db_session.add_all(req_sessions)
+    await db_session.commit()
+    return req_sessions
+
+
 async def read_request_session(
     db_session: Session, req_session_id: str,
 ) -> RequestSession | None:
@@ -32,11 +51,42 @@ async def read_request_session(
     return result.scalar_one_or_none()
 
 
+async def _delete_request_sessions(
+    db_session: Session, req_session_ids: list[str],
+) -> dict[str, int]:
+    # SQLite does not enforce the ON DELETE CASCADE unless asked to, so the
+    # children go first, each through its session_id index.
+    reclaimed: dict[str, int] = {}
+    for table in (RequestHeader, RequestBody, ResponseHeader, RequestSession):
+        column = table.id if table is RequestSession else table.session_id
+        result = await db_session.execute(
+            delete(table)
+            .where(column.in_(req_session_ids))
+            .execution_options(synchronize_session=False)
+        )
+        reclaimed[table.__tablename__] = result.rowcount
+    await db_session.commit()
+    return reclaimed
+
+
 async def delete_request_session(db_session: Session, req_session_id: str) -> None:
-    stmt = delete(RequestSession).where(
-        (RequestSession.id == req_session_id) | (RequestSession.exp < datetime.now())
+    await _delete_request_sessions(db_session, [req_session_id])
+
+
+async def delete_expired_request_sessions(
+    db_session: Session, limit: int,
+) -> dict[str, int]:
+    """Delete up to `limit` expired sessions, returning rows deleted per table."""
+    stmt = (
+        select(RequestSession.id)
+        .where(RequestSession.exp <= datetime.now())
+        .order_by(RequestSession.exp)
+        .limit(limit)
     )
-    await db_session.execute(stmt)
+    req_session_ids = list((await db_session.execute(stmt)).scalars())
+    if not req_session_ids:
+        return {}
+    return await _delete_request_sessions(db_session, req_session_ids)
 
 
 async def create_request_header(
@@ -49,6 +99,19 @@ async def create_request_header(
     return req_header
 
 
+async def create_request_headers(
+    db_session: Session, req_session_id: str, headers: list[tuple[str, str]],
+) -> list[RequestHeader]:
+    req_headers = [
+        RequestHeader(session_id=req_session_id, name=name, value=value)
+        for name, value in headers
+    ]
+
+    db_session.add_all(req_headers)
+    await db_session.commit()
+    return req_headers
+
+
 async def read_request_headers(
     db_session: Session, req_session_id: str,
 ) -> list[RequestHeader]:
@@ -57,23 +120,76 @@ async def read_request_headers(
     return result.scalars().all()
 
 
+def _upsert_request_bodies_stmt(dialect: str, rows: list[dict[str, Any]]) -> Any:
+    if dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    elif dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        return None
+
+    stmt = insert(RequestBody).values(rows)
+    return stmt.on_conflict_do_update(
+        index_elements=[RequestBody.session_id, RequestBody.index],
+        set_={"value": stmt.excluded.value},
+    )
+
+
+async def upsert_request_bodies(
+    db_session: Session, req_session_id: str, bodies: list[tuple[int, str]],
+) -> list[RequestBody]:
+    """Store `(index, value)` rows with bulk statements and one commit.
+
+    Rows replace earlier ones with the same index, so retried uploads are
+    harmless. Dialects without `ON CONFLICT` fall back to one lookup per row.
+    """
+    req_bodies = [
+        RequestBody(session_id=req_session_id, index=index, value=value)
+        for index, value in bodies
+    ]
+    dialect = db_session.bind.dialect.name
+
+    for start in range(0, len(req_bodies), UPSERT_BATCH_SIZE):
+        batch = req_bodies[start : start + UPSERT_BATCH_SIZE]
+        rows = [
+            {"session_id": req_session_id, "index": b.index, "value": b.value}
+            for b in batch
+        ]
+        stmt = _upsert_request_bodies_stmt(dialect, rows)
+        if stmt is not None:
+            await db_session.execute(stmt)
+            continue
+
+        for req_body in batch:
+            stmt = select(RequestBody).where(
+                RequestBody.session_id == req_session_id,
+                RequestBody.index == req_body.index,
+            )
+            result = await db_session.execute(stmt)
+            if (stored := result.scalar_one_or_none()) is None:
+                db_session.add(req_body)
+            else:
+                stored.value = req_body.value
+
+    await db_session.commit()
+    return req_bodies
+
+
 async def create_or_update_request_body(
     db_session: Session, req_session_id: str, index: int, value: str,
 ) -> RequestBody:
-    stmt = select(RequestBody).where(
-        RequestBody.session_id == req_session_id, RequestBody.index == index
+    (req_body,) = await upsert_request_bodies(
+        db_session, req_session_id, [(index, value)]
     )
-    result = await db_session.execute(stmt)
-    req_body: RequestBody | None = result.scalar_one_or_none()
+    return req_body
 
-    if req_body is None:
-        req_body = RequestBody(session_id=req_session_id, index=index, value=value)
-        db_session.add(req_body)
-    else:
-        req_body.value = value
 
-    await db_session.commit()
-    return req_body
+async def create_request_bodies(
+    db_session: Session, req_session_id: str, values: list[str],
+) -> list[RequestBody]:
+    return await upsert_request_bodies(
+        db_session, req_session_id, list(enumerate(values))
+    )
 
 
 async def read_request_bodies(
@@ -88,6 +204,41 @@ async def read_request_bodies(
     return result.scalars().all()
 
 
+async def read_request_body_indexes(
+    db_session: Session, req_session_id: str,
+) -> list[int]:
+    stmt = (
+        select(RequestBody.index)
+        .where(RequestBody.session_id == req_session_id)
+        .order_by(RequestBody.index.asc())
+    )
+    result = await db_session.execute(stmt)
+    return result.scalars().all()
+
+
+async def iter_request_bodies(
+    db_session: Session, req_session_id: str, page_size: int,
+) -> AsyncGenerator[RequestBody, None]:
+    """Yield body rows in index order, reading `page_size` rows at a time."""
+    last_index = -1
+    while True:
+        stmt = (
+            select(RequestBody)
+            .where(
+                RequestBody.session_id == req_session_id,
+                RequestBody.index > last_index,
+            )
+            .order_by(RequestBody.index.asc())
+            .limit(page_size)
+        )
+        req_bodies = (await db_session.execute(stmt)).scalars().all()
+        for req_body in req_bodies:
+            yield req_body
+        if len(req_bodies) < page_size:
+            return
+        last_index = req_bodies[-1].index
+
+
 async def create_response_header(
     db_session: Session, req_session_id: str, name: str, value: str,
 ) -> ResponseHeader:
@@ -98,6 +249,19 @@ async def create_response_header(
     return resp_header
 
 
+async def create_response_headers(
+    db_session: Session, req_session_id: str, headers: list[tuple[str, str]],
+) -> list[ResponseHeader]:
+    resp_headers = [
+        ResponseHeader(session_id=req_session_id, name=name, value=value)
+        for name, value in headers
+    ]
+
+    db_session.add_all(resp_headers)
+    await db_session.commit()
+    return resp_headers
+
+
 async def read_response_headers(
     db_session: Session, req_session_id: str,
 ) -> list[ResponseHeader]:
@@ -0,0 +1,204 @@
+import logging
+from collections import OrderedDict
+from datetime import datetime
+from typing import AsyncGenerator
+
+from .crud import new_request_session
+from .storage import Storage, StorageFull
+from .tables import RequestBody, RequestHeader, RequestSession, ResponseHeader
+
+logger = logging.getLogger("gemini.database")
+
+ROW_OVERHEAD = 64  # rough per-row bookkeeping, in bytes
+
+
+class _Entry(object):
+    __slots__ = ("session", "headers", "bodies", "resp_headers", "size")
+
+    def __init__(self, session: RequestSession):
+        self.session = session
+        self.headers: list[RequestHeader] = []
+        self.bodies: dict[int, RequestBody] = {}
+        self.resp_headers: list[ResponseHeader] = []
+        self.size = ROW_OVERHEAD + len(session.id) + len(session.secret)
+
+
+class MemoryStorage(Storage):
+    """Process-local storage that keeps every session in a dict.
+
+    Sessions expire after `exp`, and the least recently used ones are evicted
+    once there are more than `max_sessions` of them or their rows take more
+    than about `max_bytes`. Nothing survives a restart.
+    """
+
+    def __init__(self, max_sessions: int, max_bytes: int):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _get(self, req_session_id: str) -> _Entry | None:
+        entry = self._entries.get(req_session_id)
+        if entry is None:
+            return None
+        if entry.session.exp <= datetime.now():
+            self._evict(req_session_id)
+            return None
+
+        self._entries.move_to_end(req_session_id)
+        return entry
+
+    def _evict(self, req_session_id: str) -> None:
+        entry = self._entries.pop(req_session_id, None)
+        if entry is not None:
+            self.size -= entry.size
+
+    def _grow(self, entry: _Entry, size: int) -> None:
+        entry.size += size
+        self.size += size
+        # a session that cannot fit at all must not push out the others first
+        if entry.size > self.max_bytes:
+            self._evict(entry.session.id)
+            raise StorageFull(f"session {entry.session.id} exceeds memory_max_bytes")
+
+        for req_session_id in list(self._entries):
+            if len(self._entries) <= self.max_sessions and self.size <= self.max_bytes:
+                break
+            if req_session_id != entry.session.id:
+                logger.debug("Evict Session - %s", req_session_id)
+                self._evict(req_session_id)
+
+    def _require(self, req_session_id: str) -> _Entry:
+        entry = self._get(req_session_id)
+        if entry is None:
+            raise StorageFull(f"session {req_session_id} was evicted")
+        return entry
+
+    async def create_request_session(self) -> RequestSession:
+        req_session = new_request_session()
+        entry = _Entry(req_session)
+        self._entries[req_session.id] = entry
+        self.size += entry.size
+        self._grow(entry, 0)
+        return req_session
+
+    async def create_request_sessions(self, count: int) -> list[RequestSession]:
+        return [await self.create_request_session() for _ in range(count)]
+
+    async def read_request_session(self, req_session_id: str) -> RequestSession | None:
+        entry = self._get(req_session_id)
+        return None if entry is None else entry.session
+
+    async def delete_request_session(self, req_session_id: str) -> None:
+        self._evict(req_session_id)
+
+    async def delete_expired_request_sessions(self, limit: int) -> dict[str, int]:
+        now = datetime.now()
+        expired = [e for e in self._entries.values() if e.session.exp <= now][:limit]
+
+        reclaimed: dict[str, int] = {}
+        for entry in expired:
+            for table, rows in (
+                (RequestHeader, len(entry.headers)),
+                (RequestBody, len(entry.bodies)),
+                (ResponseHeader, len(entry.resp_headers)),
+                (RequestSession, 1),
+            ):
+                name = table.__tablename__
+                reclaimed[name] = reclaimed.get(name, 0) + rows
+            self._evict(entry.session.id)
+        return reclaimed
+
+    async def create_request_header(
+        self, req_session_id: str, name: str, value: str,
+    ) -> RequestHeader:
+        return (await self.create_request_headers(req_session_id, [(name, value)]))[0]
+
+    async def create_request_headers(
+        self, req_session_id: str, headers: list[tuple[str, str]],
+    ) -> list[RequestHeader]:
+        entry = self._require(req_session_id)
+        req_headers = [
+            RequestHeader(session_id=req_session_id, name=name, value=value)
+            for name, value in headers
+        ]
+        entry.headers += req_headers
+        self._grow(entry, sum(ROW_OVERHEAD + len(n) + len(v) for n, v in headers))
+        return req_headers
+
+    async def read_request_headers(self, req_session_id: str) -> list[RequestHeader]:
+        entry = self._get(req_session_id)
+        return [] if entry is None else list(entry.headers)
+
+    async def create_or_update_request_body(
+        self, req_session_id: str, index: int, value: str,
+    ) -> RequestBody:
+        entry = self._require(req_session_id)
+        req_body = entry.bodies.get(index)
+        if req_body is None:
+            req_body = RequestBody(session_id=req_session_id, index=index, value=value)
+            entry.bodies[index] = req_body
+            self._grow(entry, ROW_OVERHEAD + len(value))
+        else:
+            size = len(value) - len(req_body.value)
+            req_body.value = value
+            self._grow(entry, size)
+        return req_body
+
+    async def create_request_bodies(
+        self, req_session_id: str, values: list[str],
+    ) -> list[RequestBody]:
+        entry = self._require(req_session_id)
+        req_bodies = [
+            RequestBody(session_id=req_session_id, index=index, value=value)
+            for index, value in enumerate(values)
+        ]
+        size = 0
+        for req_body in req_bodies:
+            replaced = entry.bodies.get(req_body.index)
+            if replaced is not None:
+                size -= ROW_OVERHEAD + len(replaced.value)
+            entry.bodies[req_body.index] = req_body
+            size += ROW_OVERHEAD + len(req_body.value)
+        self._grow(entry, size)
+        return req_bodies
+
+    async def read_request_bodies(self, req_session_id: str) -> list[RequestBody]:
+        entry = self._get(req_session_id)
+        return [] if entry is None else [entry.bodies[i] for i in sorted(entry.bodies)]
+
+    async def read_request_body_indexes(self, req_session_id: str) -> list[int]:
+        entry = self._get(req_session_id)
+        return [] if entry is None else sorted(entry.bodies)
+
+    async def iter_request_bodies(
+        self, req_session_id: str, page_size: int,
+    ) -> AsyncGenerator[RequestBody, None]:
+        # rows are already in memory; look the session up again per row since
+        # it may be evicted while the upstream is reading
+        for index in await self.read_request_body_indexes(req_session_id):
+            yield self._require(req_session_id).bodies[index]
+
+    async def create_response_header(
+        self, req_session_id: str, name: str, value: str,
+    ) -> ResponseHeader:
+        return (await self.create_response_headers(req_session_id, [(name, value)]))[0]
+
+    async def create_response_headers(
+        self, req_session_id: str, headers: list[tuple[str, str]],
+    ) -> list[ResponseHeader]:
+        entry = self._require(req_session_id)
+        resp_headers = [
+            ResponseHeader(session_id=req_session_id, name=name, value=value)
+            for name, value in headers
+        ]
+        entry.resp_headers += resp_headers
+        self._grow(entry, sum(ROW_OVERHEAD + len(n) + len(v) for n, v in headers))
+        return resp_headers
+
+    async def read_response_headers(self, req_session_id: str) -> list[ResponseHeader]:
+        entry = self._get(req_session_id)
+        return [] if entry is None else list(entry.resp_headers)
@@ -0,0 +1,39 @@
+import asyncio
+import logging
+
+from gemini.metrics import Counter
+
+from . import scoped_storage
+
+logger = logging.getLogger("gemini.database")
+
+reclaimed_rows = Counter(
+    "gemini_reaped_rows_total", "Rows of expired sessions deleted.", ("table",)
+)
+
+
+async def reap_expired_sessions(interval: float, batch_size: int) -> None:
+    """Delete expired sessions every `interval` seconds, `batch_size` at a time.
+
+    Each batch is its own transaction, so requests are not held up for
+    longer than one batch however much has piled up.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            while True:
+                async with scoped_storage() as storage:
+                    reclaimed = await storage.delete_expired_request_sessions(
+                        batch_size
+                    )
+                if not reclaimed:
+                    break
+
+                for table, rows in reclaimed.items():
+                    reclaimed_rows.inc(table, amount=rows)
+                logger.info("Reap Sessions - %s", reclaimed)
+                if reclaimed.get("request_session", 0) < batch_size:
+                    break
+                await asyncio.sleep(0)
+        except Exception:
+            logger.exception("Reap Sessions Failed")
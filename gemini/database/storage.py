@@ -0,0 +1,206 @@
+import asyncio
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager, nullcontext
+from typing import AsyncContextManager, AsyncGenerator, AsyncIterator
+
+from sqlalchemy.ext.asyncio.session import AsyncSession as Session
+
+from . import crud
+from .tables import RequestBody, RequestHeader, RequestSession, ResponseHeader
+
+
+class StorageFull(Exception):
+    pass
+
+
+class Storage(ABC):
+    """Tunnel state used by castor, mirroring the functions of `crud`."""
+
+    @abstractmethod
+    async def create_request_session(self) -> RequestSession:
+        ...
+
+    @abstractmethod
+    async def create_request_sessions(self, count: int) -> list[RequestSession]:
+        ...
+
+    @abstractmethod
+    async def read_request_session(self, req_session_id: str) -> RequestSession | None:
+        ...
+
+    @abstractmethod
+    async def delete_request_session(self, req_session_id: str) -> None:
+        ...
+
+    @abstractmethod
+    async def delete_expired_request_sessions(self, limit: int) -> dict[str, int]:
+        ...
+
+    @abstractmethod
+    async def create_request_header(
+        self, req_session_id: str, name: str, value: str,
+    ) -> RequestHeader:
+        ...
+
+    @abstractmethod
+    async def create_request_headers(
+        self, req_session_id: str, headers: list[tuple[str, str]],
+    ) -> list[RequestHeader]:
+        ...
+
+    @abstractmethod
+    async def read_request_headers(self, req_session_id: str) -> list[RequestHeader]:
+        ...
+
+    @abstractmethod
+    async def create_or_update_request_body(
+        self, req_session_id: str, index: int, value: str,
+    ) -> RequestBody:
+        ...
+
+    @abstractmethod
+    async def create_request_bodies(
+        self, req_session_id: str, values: list[str],
+    ) -> list[RequestBody]:
+        ...
+
+    @abstractmethod
+    async def read_request_bodies(self, req_session_id: str) -> list[RequestBody]:
+        ...
+
+    @abstractmethod
+    async def read_request_body_indexes(self, req_session_id: str) -> list[int]:
+        ...
+
+    @abstractmethod
+    def iter_request_bodies(
+        self, req_session_id: str, page_size: int,
+    ) -> AsyncGenerator[RequestBody, None]:
+        ...
+
+    @abstractmethod
+    async def create_response_header(
+        self, req_session_id: str, name: str, value: str,
+    ) -> ResponseHeader:
+        ...
+
+    @abstractmethod
+    async def create_response_headers(
+        self, req_session_id: str, headers: list[tuple[str, str]],
+    ) -> list[ResponseHeader]:
+        ...
+
+    @abstractmethod
+    async def read_response_headers(self, req_session_id: str) -> list[ResponseHeader]:
+        ...
+
+
+class SQLStorage(Storage):
+    """`crud` over one database session, each call a committed unit of work.
+
+    With `lock`, units run one at a time. Sessions sharing a connection
+    would otherwise see, and on checkin roll back, each other's pending
+    writes.
+    """
+
+    def __init__(self, db_session: Session, lock: asyncio.Lock | None = None):
+        self.db_session = db_session
+        self.lock = lock
+
+    @asynccontextmanager
+    async def unit(self) -> AsyncIterator[Session]:
+        lock: AsyncContextManager[object] = self.lock or nullcontext()
+        async with lock:
+            try:
+                yield self.db_session
+                await self.db_session.commit()
+            except BaseException:
+                await self.db_session.rollback()
+                raise
+
+    async def create_request_session(self) -> RequestSession:
+        async with self.unit() as db:
+            return await crud.create_request_session(db)
+
+    async def create_request_sessions(self, count: int) -> list[RequestSession]:
+        async with self.unit() as db:
+            return await crud.create_request_sessions(db, count)
+
+    async def read_request_session(self, req_session_id: str) -> RequestSession | None:
+        async with self.unit() as db:
+            return await crud.read_request_session(db, req_session_id)
+
+    async def delete_request_session(self, req_session_id: str) -> None:
+        async with self.unit() as db:
+            await crud.delete_request_session(db, req_session_id)
+
+    async def delete_expired_request_sessions(self, limit: int) -> dict[str, int]:
+        async with self.unit() as db:
+            return await crud.delete_expired_request_sessions(db, limit)
+
+    async def create_request_header(
+        self, req_session_id: str, name: str, value: str,
+    ) -> RequestHeader:
+        async with self.unit() as db:
+            return await crud.create_request_header(db, req_session_id, name, value)
+
+    async def create_request_headers(
+        self, req_session_id: str, headers: list[tuple[str, str]],
+    ) -> list[RequestHeader]:
+        async with self.unit() as db:
+            return await crud.create_request_headers(db, req_session_id, headers)
+
+    async def read_request_headers(self, req_session_id: str) -> list[RequestHeader]:
+        async with self.unit() as db:
+            return await crud.read_request_headers(db, req_session_id)
+
+    async def create_or_update_request_body(
+        self, req_session_id: str, index: int, value: str,
+    ) -> RequestBody:
+        async with self.unit() as db:
+            return await crud.create_or_update_request_body(
+                db, req_session_id, index, value
+            )
+
+    async def create_request_bodies(
+        self, req_session_id: str, values: list[str],
+    ) -> list[RequestBody]:
+        async with self.unit() as db:
+            return await crud.create_request_bodies(db, req_session_id, values)
+
+    async def read_request_bodies(self, req_session_id: str) -> list[RequestBody]:
+        async with self.unit() as db:
+            return await crud.read_request_bodies(db, req_session_id)
+
+    async def read_request_body_indexes(self, req_session_id: str) -> list[int]:
+        async with self.unit() as db:
+            return await crud.read_request_body_indexes(db, req_session_id)
+
+    async def iter_request_bodies(
+        self, req_session_id: str, page_size: int,
+    ) -> AsyncGenerator[RequestBody, None]:
+        rows = crud.iter_request_bodies(self.db_session, req_session_id, page_size)
+        while True:
+            # a unit per row, so the lock is not held while the caller works
+            async with self.unit():
+                try:
+                    row = await rows.__anext__()
+                except StopAsyncIteration:
+                    return
+            yield row
+
+    async def create_response_header(
+        self, req_session_id: str, name: str, value: str,
+    ) -> ResponseHeader:
+        async with self.unit() as db:
+            return await crud.create_response_header(db, req_session_id, name, value)
+
+    async def create_response_headers(
+        self, req_session_id: str, headers: list[tuple[str, str]],
+    ) -> list[ResponseHeader]:
+        async with self.unit() as db:
+            return await crud.create_response_headers(db, req_session_id, headers)
+
+    async def read_response_headers(self, req_session_id: str) -> list[ResponseHeader]:
+        async with self.unit() as db:
+            return await crud.read_response_headers(db, req_session_id)
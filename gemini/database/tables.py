@@ -1,4 +1,4 @@
-from sqlalchemy.sql.schema import Column, ForeignKey
+from sqlalchemy.sql.schema import Column, ForeignKey, Index
 from sqlalchemy.sql.sqltypes import INTEGER, TIMESTAMP, VARCHAR
 
 from ._base import Base
@@ -11,7 +11,7 @@ class RequestSession(Base):
 
     id = Column(VARCHAR(), primary_key=True)
     secret = Column(VARCHAR(), nullable=False)
-    exp = Column(TIMESTAMP(), nullable=False)
+    exp = Column(TIMESTAMP(), nullable=False, index=True)
 
 
 class RequestHeader(Base):
@@ -21,6 +21,7 @@ class RequestHeader(Base):
     session_id = Column(
         ForeignKey("request_session.id", onupdate="CASCADE", ondelete="CASCADE"),
         nullable=False,
+        index=True,
     )
     name = Column(VARCHAR(), nullable=False)
     value = Column(VARCHAR(), nullable=False)
@@ -28,6 +29,9 @@ class RequestHeader(Base):
 
 class RequestBody(Base):
     __tablename__ = "request_body"
+    __table_args__ = (
+        Index("ux_request_body_session_id_index", "session_id", "index", unique=True),
+    )
 
     id = Column(INTEGER(), primary_key=True)
     session_id = Column(
@@ -45,6 +49,7 @@ class ResponseHeader(Base):
     session_id = Column(
         ForeignKey("request_session.id", onupdate="CASCADE", ondelete="CASCADE"),
         nullable=False,
+        index=True,
     )
     name = Column(VARCHAR(), nullable=False)
     value = Column(VARCHAR(), nullable=False)
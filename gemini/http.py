@@ -1,11 +1,286 @@
 import logging
-from typing import AsyncGenerator
 
 import httpx
 
+from gemini.config import config
+from gemini.core.cache import ResponseCache
+from gemini.core.mux import MuxClient
+from gemini.core.sessions import SessionPool
+from gemini.core.upstream import UpstreamTransport, environment_proxies
+from gemini.metrics import Gauge
+
 logger = logging.getLogger(__name__)
 
+castor_client: httpx.AsyncClient | None = None
+upstream_client: httpx.AsyncClient | None = None
+upstream_transport: UpstreamTransport | None = None
+castor_requests = 0
+mux_client: MuxClient | None = None
+session_pool: SessionPool | None = None
+response_cache: ResponseCache | None = None
+
+
+def get_upstream_client() -> httpx.AsyncClient:
+    """App-lifetime client for castor -> upstream calls, pooled per host."""
+    global upstream_client, upstream_transport
+
+    if upstream_client is None:
+        limits = httpx.Limits(
+            max_connections=config.upstream_max_connections_per_host,
+            max_keepalive_connections=config.upstream_max_keepalive_per_host,
+            keepalive_expiry=config.upstream_keepalive_expiry,
+        )
+        upstream_transport = UpstreamTransport(
+            limits,
+            http2=config.upstream_http2,
+            dns_ttl=config.upstream_dns_ttl,
+            max_hosts=config.upstream_max_hosts,
+            trust_env=config.upstream_trust_env,
+        )
+        upstream_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(
+                config.upstream_read_timeout, connect=config.upstream_connect_timeout
+            ),
+            transport=upstream_transport,
+            mounts=upstream_proxies(limits),
+            trust_env=config.upstream_trust_env,
+        )
+
+    return upstream_client
+
+
+async def upstream_client_dependency() -> httpx.AsyncClient:
+    # see castor_client_dependency
+    return get_upstream_client()
+
+
+def upstream_proxies(
+    limits: httpx.Limits,
+) -> dict[str, httpx.AsyncBaseTransport | None]:
+    # httpx only reads proxies from the environment when it picks the
+    # transport itself; hosts mapped to None use the per-host pools.
+    if config.upstream_proxy:
+        proxies: dict[str, str | None] = {"all://": config.upstream_proxy}
+    elif config.upstream_trust_env:
+        proxies = environment_proxies()
+    else:
+        return {}
+    return {
+        pattern: httpx.AsyncHTTPTransport(
+            proxy=url,
+            limits=limits,
+            http2=config.upstream_http2,
+            trust_env=config.upstream_trust_env,
+        )
+        if url
+        else None
+        for pattern, url in proxies.items()
+    }
+
+
+async def close_upstream_client() -> None:
+    global upstream_client, upstream_transport
+
+    if upstream_client is not None:
+        logger.info("Upstream client stats: %s", upstream_client_stats())
+        await upstream_client.aclose()
+        upstream_client = None
+        upstream_transport = None
+
+
+def upstream_client_stats() -> dict[str, int]:
+    if upstream_transport is None:
+        return {}
+    return upstream_transport.stats()
+
+
+async def _count_castor_request(request: httpx.Request) -> None:
+    global castor_requests
+    castor_requests += 1
+
+
+def get_castor_client() -> httpx.AsyncClient:
+    """App-lifetime client for pollux -> castor calls, keeping connections alive."""
+    global castor_client
+
+    if castor_client is None:
+        limits = httpx.Limits(
+            max_connections=config.castor_max_connections,
+            max_keepalive_connections=config.castor_max_keepalive_connections,
+            keepalive_expiry=config.castor_keepalive_expiry,
+        )
+        castor_client = httpx.AsyncClient(
+            timeout=60,
+            limits=limits,
+            http2=config.castor_http2,
+            event_hooks={"request": [_count_castor_request]},
+        )
+
+    return castor_client
+
+
+async def castor_client_dependency() -> httpx.AsyncClient:
+    # FastAPI runs plain def dependencies in its threadpool, where concurrent
+    # first requests would each build, and leak, a client of their own.
+    return get_castor_client()
+
+
+async def close_castor_client() -> None:
+    global castor_client
+
+    if castor_client is not None:
+        logger.info("Castor client stats: %s", castor_client_stats())
+        await castor_client.aclose()
+        castor_client = None
+
+
+def pool_stats(client: httpx.AsyncClient) -> dict[str, int]:
+    # httpx does not expose its connection pool, so peek at httpcore's.
+    pool = getattr(client._transport, "_pool", None)
+    connections = list(getattr(pool, "connections", []))
+    return {
+        "connections": len(connections),
+        "idle": sum(1 for conn in connections if conn.is_idle()),
+        "http2": sum(1 for conn in connections if conn.info().startswith("HTTP/2")),
+    }
+
+
+def castor_client_stats() -> dict[str, int]:
+    stats = {"requests": castor_requests}
+    if castor_client is not None:
+        stats |= pool_stats(castor_client)
+    return stats
+
+
+def get_mux_client() -> MuxClient:
+    """App-lifetime WebSocket tunnel to castor's `/live`."""
+    global mux_client
+
+    if mux_client is None:
+        url = config.castor_url_base.replace("http", "ws", 1) + "/live"
+        mux_client = MuxClient(
+            url,
+            config.secert,
+            connections=config.mux_connections,
+            max_streams=config.mux_max_streams,
+            window=config.mux_window,
+            max_backoff=config.mux_max_backoff,
+        )
+
+    return mux_client
+
+
+async def close_mux_client() -> None:
+    global mux_client
+
+    if mux_client is not None:
+        await mux_client.aclose()
+        mux_client = None
+
+
+def get_session_pool() -> SessionPool:
+    """App-lifetime pool of castor sessions, filled in the background."""
+    global session_pool
+
+    if session_pool is None:
+        session_pool = SessionPool(
+            get_castor_client(),
+            config.castor_url_base,
+            config.secert,
+            size=config.session_pool_size,
+            refill_interval=config.session_pool_refill_interval,
+            margin=config.session_pool_margin,
+        )
+
+    return session_pool
+
+
+async def close_session_pool() -> None:
+    global session_pool
+
+    if session_pool is not None:
+        logger.info(
+            "Session pool stats: hits=%s misses=%s",
+            session_pool.hits,
+            session_pool.misses,
+        )
+        await session_pool.aclose()
+        session_pool = None
+
+
+def get_response_cache() -> ResponseCache | None:
+    """castor's cache of upstream responses, None when it is turned off."""
+    global response_cache
+
+    enabled = config.cache_memory_bytes > 0 or config.cache_disk_dir is not None
+    if response_cache is None and enabled:
+        response_cache = ResponseCache(
+            config.cache_memory_bytes,
+            config.cache_max_entry_bytes,
+            disk_dir=config.cache_disk_dir,
+            disk_bytes=config.cache_disk_bytes,
+            disk_threshold=config.cache_disk_threshold,
+        )
+
+    return response_cache
+
+
+def close_response_cache() -> None:
+    global response_cache
+
+    if response_cache is not None:
+        logger.info("Response cache stats: %s", response_cache.stats())
+        response_cache.close()
+        response_cache = None
+
+
+def _client_metrics() -> dict[tuple[str, ...], float]:
+    if castor_client is None:
+        return {}
+    return {(name,): value for name, value in castor_client_stats().items()}
+
+
+def _upstream_client_metrics() -> dict[tuple[str, ...], float]:
+    return {(name,): value for name, value in upstream_client_stats().items()}
+
+
+def _session_pool_metrics() -> dict[tuple[str, ...], float]:
+    if session_pool is None:
+        return {}
+    return {
+        ("ready",): len(session_pool),
+        ("hits",): session_pool.hits,
+        ("misses",): session_pool.misses,
+    }
+
+
+def _response_cache_metrics() -> dict[tuple[str, ...], float]:
+    if response_cache is None:
+        return {}
+    return {(name,): value for name, value in response_cache.stats().items()}
+
 
-async def get_http_client() -> AsyncGenerator[httpx.AsyncClient, None]:
-    async with httpx.AsyncClient(timeout=60) as client:
-        yield client
+Gauge(
+    "gemini_castor_client",
+    "pollux -> castor client requests and pooled connections.",
+    _client_metrics,
+    ("stat",),
+)
+Gauge(
+    "gemini_upstream_client",
+    "castor -> upstream pools: hosts, requests in flight and connections.",
+    _upstream_client_metrics,
+    ("stat",),
+)
+Gauge(
+    "gemini_session_pool",
+    "pollux's pre-warmed sessions.",
+    _session_pool_metrics,
+    ("stat",),
+)
+Gauge(
+    "gemini_response_cache",
+    "castor's cached upstream responses and their size per tier.",
+    _response_cache_metrics,
+    ("stat",),
+)
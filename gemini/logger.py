@@ -1,5 +1,11 @@
+import atexit
+import copy
 import logging
+import queue
 import sys
+import time
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any
 
 import fastapi
 import h11
@@ -10,11 +16,112 @@ import uvicorn
 from rich.logging import RichHandler
 
 from gemini.config import config
+from gemini.metrics import dropped_log_records
 
 LOG_FORMAT = "%(name)s - %(message)s"
 
+listener: QueueListener | None = None
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Queue records with only their message rendered, dropping them when full.
+
+    The arguments may change before the writer thread gets to them, so the
+    message and traceback are rendered here; the rest of the formatting
+    happens on the writer thread, and a full queue never blocks the event
+    loop.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped_log_records.inc("queue_full")
+
+
+class RateLimitFilter(logging.Filter):
+    """Token bucket per logger, `rate` records per second in bursts of `burst`.
+
+    `rates` overrides `rate` for single loggers. Warnings and errors always
+    pass.
+    """
+
+    def __init__(self, rate: float, burst: int, rates: dict[str, float]):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.rates = rates
+        self._buckets: dict[str, tuple[float, float]] = {}  # tokens, last refill
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = self.rates.get(record.name, self.rate)
+        if rate <= 0 or record.levelno >= logging.WARNING:
+            return True
+
+        now = time.monotonic()
+        tokens, last = self._buckets.get(record.name, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * rate)
+        if tokens < 1:
+            self._buckets[record.name] = (tokens, now)
+            dropped_log_records.inc("rate_limit")
+            return False
+        self._buckets[record.name] = (tokens - 1, now)
+        return True
+
+
+class Shortened(str):
+    # a cut `repr`, printed as is by both %s and %r
+    def __repr__(self) -> str:
+        return str(self)
+
+
+class TruncateFilter(logging.Filter):
+    """Cut every argument of a record to `max_length` characters."""
+
+    def __init__(self, max_length: int):
+        super().__init__()
+        self.max_length = max_length
+
+    def shorten(self, value: Any) -> Any:
+        n = self.max_length
+        if isinstance(value, Shortened):
+            return value
+        if isinstance(value, (str, bytes)):
+            if len(value) <= n:
+                return value
+            return Shortened(f"{value[:n]!r}...(+{len(value) - n})")
+        if isinstance(value, (int, float, bool)) or value is None:
+            return value
+        text = repr(value)
+        if len(text) <= n:
+            return value
+        return Shortened(f"{text[:n]}...(+{len(text) - n})")
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        n = self.max_length
+        if isinstance(record.args, dict):
+            record.args = {k: self.shorten(v) for k, v in record.args.items()}
+        elif record.args:
+            record.args = tuple(self.shorten(arg) for arg in record.args)
+        elif isinstance(record.msg, str) and len(record.msg) > n:
+            record.msg = f"{record.msg[:n]}...(+{len(record.msg) - n})"
+        return True
+
 
 def setup_logger() -> None:
+    global listener
+
     log_level = logging.INFO
     if config.debug:
         log_level = logging.DEBUG
@@ -55,4 +162,29 @@ def setup_logger() -> None:
         )
         handlers.append(stream_handler)
 
-    logging.basicConfig(level=log_level, handlers=handlers)
+    # The handlers write from a background thread, so a slow stdout no
+    # longer holds up the event loop.
+    stop_logger()
+    queue_handler = DroppingQueueHandler(queue.Queue(config.log_queue_size))
+    queue_handler.addFilter(
+        RateLimitFilter(config.log_rate_limit, config.log_burst, config.log_rate_limits)
+    )
+    if config.log_max_field_length > 0:
+        # the arguments are rendered once queued, so they are cut before
+        queue_handler.addFilter(TruncateFilter(config.log_max_field_length))
+    listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+
+    logging.basicConfig(level=log_level, handlers=[queue_handler], force=True)
+
+
+def stop_logger() -> None:
+    """Write out the queued records and stop the writer thread."""
+    global listener
+
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+
+atexit.register(stop_logger)
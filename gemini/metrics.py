@@ -0,0 +1,268 @@
+"""In-process metrics rendered in the Prometheus text format.
+
+Everything here is touched from the event loop only, so the counters are
+plain numbers without locks; each worker process keeps its own.
+"""
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import AsyncGenerator, AsyncIterator, Callable, Iterator, TypeVar
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+T = TypeVar("T", bytes, memoryview)
+
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+    10.0, 30.0,
+)  # fmt: skip
+
+RATIO_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0, 1.1)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{n}="{v}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric(ABC):
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        REGISTRY.append(self)
+
+    @abstractmethod
+    def samples(self) -> Iterator[str]:
+        ...
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        yield from self.samples()
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, help, labels)
+        self.values: defaultdict[tuple[str, ...], float] = defaultdict(float)
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        self.values[labels] += amount
+
+    def samples(self) -> Iterator[str]:
+        for labels, value in sorted(self.values.items()):
+            yield f"{self.name}{_labels(self.labels, labels)} {value}"
+
+
+class Gauge(Metric):
+    """A value read from `collect` when the metrics are scraped."""
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        collect: Callable[[], dict[tuple[str, ...], float]],
+        labels: tuple[str, ...] = (),
+    ):
+        super().__init__(name, help, labels)
+        self.collect = collect
+
+    def samples(self) -> Iterator[str]:
+        for labels, value in sorted(self.collect().items()):
+            yield f"{self.name}{_labels(self.labels, labels)} {value}"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        # per label set: one count per bucket plus +Inf, then sum
+        self.values: dict[tuple[str, ...], list[float]] = {}
+
+    def observe(self, *labels: str, value: float) -> None:
+        counts = self.values.get(labels)
+        if counts is None:
+            counts = self.values[labels] = [0.0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    @contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(*labels, value=time.perf_counter() - started)
+
+    def samples(self) -> Iterator[str]:
+        for labels, counts in sorted(self.values.items()):
+            total = 0.0
+            bounds = [str(b) for b in self.buckets] + ["+Inf"]
+            for bound, count in zip(bounds, counts):
+                total += count
+                le = _labels(self.labels, labels, f'le="{bound}"')
+                yield f"{self.name}_bucket{le} {total}"
+            yield f"{self.name}_sum{_labels(self.labels, labels)} {counts[-1]}"
+            yield f"{self.name}_count{_labels(self.labels, labels)} {total}"
+
+
+REGISTRY: list[Metric] = []
+
+
+def render() -> str:
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+phase_seconds = Histogram(
+    "gemini_phase_seconds",
+    "Time spent in each phase of a proxied request.",
+    ("server", "phase"),
+)
+endpoint_seconds = Histogram(
+    "gemini_endpoint_seconds",
+    "Time until an endpoint starts its response.",
+    ("server", "endpoint", "status"),
+)
+db_query_seconds = Histogram(
+    "gemini_db_query_seconds",
+    "SQL statement execution time.",
+    ("statement",),
+)
+transferred_bytes = Counter(
+    "gemini_bytes_total",
+    "Body bytes moved, by peer and direction.",
+    ("server", "peer", "direction"),
+)
+cipher_seconds = Counter(
+    "gemini_cipher_seconds_total", "Time spent in Potato's cipher.", ("op",)
+)
+cipher_bytes = Counter(
+    "gemini_cipher_bytes_total", "Bytes put through Potato's cipher.", ("op",)
+)
+compression_ratio = Histogram(
+    "gemini_compression_ratio",
+    "Compressed over raw size of each compressed tunnel stream.",
+    ("codec", "direction"),
+    RATIO_BUCKETS,
+)
+compression_bytes = Counter(
+    "gemini_compression_bytes_total",
+    "Tunnel stream bytes before and after compression.",
+    ("codec", "stage"),
+)
+cache_requests = Counter(
+    "gemini_cache_requests_total",
+    "Cacheable upstream requests by outcome: hit, revalidated or miss.",
+    ("result",),
+)
+cache_saved_bytes = Counter(
+    "gemini_cache_saved_bytes_total",
+    "Upstream body bytes served from castor's cache instead.",
+)
+ranged_downloads = Counter(
+    "gemini_ranged_downloads_total",
+    "Parallel ranged downloads, and their retried and failed segments.",
+    ("result",),
+)
+upstream_handshakes = Counter(
+    "gemini_upstream_handshakes_total",
+    "Connections castor opened to upstream hosts, by handshake: tcp or tls.",
+    ("kind",),
+)
+dns_lookups = Counter(
+    "gemini_dns_lookups_total",
+    "Upstream host name lookups by outcome: hit, miss or failed.",
+    ("result",),
+)
+dropped_log_records = Counter(
+    "gemini_dropped_log_records_total",
+    "Log records dropped by the rate limit or a full log queue.",
+    ("reason",),
+)
+coalesced_requests = Counter(
+    "gemini_coalesced_requests_total",
+    "Coalesced upstream requests by role: leader, follower, detached or stalled.",
+    ("role",),
+)
+compression_skipped = Counter(
+    "gemini_compression_skipped_total",
+    "Tunnel streams left uncompressed although a codec was agreed.",
+    ("reason",),
+)
+
+
+async def count_bytes(
+    stream: AsyncIterator[T], server: str, peer: str, direction: str,
+) -> AsyncGenerator[T, None]:
+    """Pass `stream` through, adding its size to `gemini_bytes_total`."""
+    labels = (server, peer, direction)
+    async for chunk in stream:
+        transferred_bytes.values[labels] += len(chunk)
+        yield chunk
+
+
+class PhaseTimer(object):
+    """Record consecutive phases of one request into `gemini_phase_seconds`."""
+
+    def __init__(self, server: str):
+        self.server = server
+        self.started = self.last = time.perf_counter()
+
+    def lap(self, phase: str) -> None:
+        now = time.perf_counter()
+        phase_seconds.observe(self.server, phase, value=now - self.last)
+        self.last = now
+
+    def done(self) -> None:
+        phase_seconds.observe(
+            self.server, "total", value=time.perf_counter() - self.started
+        )
+
+
+class EndpointMetrics(object):
+    """ASGI middleware timing every HTTP endpoint until its response starts."""
+
+    def __init__(self, app: ASGIApp, server: str):
+        self.app = app
+        self.server = server
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+
+        async def timed_send(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                endpoint = getattr(scope.get("endpoint"), "__name__", "unmatched")
+                endpoint_seconds.observe(
+                    self.server,
+                    endpoint,
+                    str(message["status"]),
+                    value=time.perf_counter() - started,
+                )
+            await send(message)
+
+        await self.app(scope, receive, timed_send)
@@ -1,48 +1,140 @@
 import asyncio
+import json
 import logging
-from typing import Any, AsyncGenerator
+from typing import Any, AsyncGenerator, Iterable
 
 import httpx
-from fastapi import BackgroundTasks, FastAPI, status
+from fastapi import BackgroundTasks, FastAPI, WebSocket, WebSocketDisconnect, status
 from fastapi.exceptions import HTTPException
-from fastapi.param_functions import Depends, Header, Query
-from fastapi.responses import StreamingResponse
-from sqlalchemy.ext.asyncio.session import AsyncSession as Session
+from fastapi.param_functions import Body, Depends, Header, Query
+from fastapi.requests import Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 
 from gemini.config import config
-from gemini.core.potato import Potato
-from gemini.database import get_session, init_db
-from gemini.database.crud import (
-    create_or_update_request_body,
-    create_request_header,
-    create_request_session,
-    create_response_header,
-    delete_request_session,
-    read_request_bodies,
-    read_request_headers,
-    read_request_session,
-    read_response_headers,
-)
+from gemini.core.coalesce import IDEMPOTENT_METHODS, Coalescer
+from gemini.core.compress import choose_codec, decompress_stream, maybe_compress
+from gemini.core.events import EventBoard, wait_until
+from gemini.core.frame import FrameError, FrameReader, FrameType, pack_frame
+from gemini.core.mux import MuxConnection, MuxStream, StreamReset
+from gemini.core.potato import Potato, PotatoDecoder, PotatoEncoder
+from gemini.core.ranged import ranged_response
+from gemini.database import get_storage, init_db, shared_state_error
+from gemini.database.reaper import reap_expired_sessions
+from gemini.database.storage import Storage, StorageFull
 from gemini.database.tables import RequestSession
-from gemini.http import get_http_client
+from gemini.http import (
+    close_response_cache,
+    close_upstream_client,
+    get_response_cache,
+    get_upstream_client,
+    upstream_client_dependency,
+)
 from gemini.logger import setup_logger
+from gemini.metrics import (
+    CONTENT_TYPE,
+    EndpointMetrics,
+    count_bytes,
+    phase_seconds,
+    render,
+)
+from gemini.utils import stream_views
 
 logger = logging.getLogger("gemini.castor")
 app = FastAPI(debug=config.debug)
+app.add_middleware(EndpointMetrics, server="castor")
+session_events = EventBoard()
+response_events = EventBoard()
+# other workers' notifications never reach this process, so poll as well
+event_poll_interval = config.event_poll_interval if config.workers > 1 else None
+reaper_task: asyncio.Task[None] | None = None
+coalescer = Coalescer(
+    get_upstream_client, config.coalesce_buffer_bytes, config.coalesce_stall_timeout
+)
+
+
+def upstream_headers(headers: Iterable[tuple[str, str]]) -> list[tuple[str, str]]:
+    if config.pass_encoded:
+        return list(headers)
+    # otherwise httpx would ask for gzip on its own
+    kept = [(n, v) for n, v in headers if n.lower() != "accept-encoding"]
+    return kept + [("accept-encoding", "identity")]
+
+
+async def send_upstream(
+    client: httpx.AsyncClient,
+    method: str,
+    url: str,
+    headers: list[tuple[str, str]],
+    content: AsyncGenerator[bytes, None] | None,
+) -> httpx.Response:
+    if content is not None:
+        content = count_bytes(content, "castor", "upstream", "out")
+    req = client.build_request(method, url, headers=headers, content=content)
+    with phase_seconds.time("castor", "upstream"):
+        if content is not None:
+            return await client.send(req, stream=True)
+        if config.coalesce_requests and method.upper() in IDEMPOTENT_METHODS:
+            return await coalescer.send(req, fetch_upstream)
+        return await fetch_upstream(client, req)
+
+
+async def fetch_upstream(
+    client: httpx.AsyncClient, req: httpx.Request
+) -> httpx.Response:
+    """Send a request without a body, through the response cache if it is on."""
+
+    async def send(req: httpx.Request) -> httpx.Response:
+        resp = await client.send(req, stream=True)
+        if not config.ranged_downloads:
+            return resp
+        return ranged_response(
+            client,
+            req,
+            resp,
+            config.ranged_segment_size,
+            config.ranged_concurrency,
+            config.ranged_min_size,
+        )
+
+    cache = get_response_cache()
+    if cache is not None:
+        return await cache.send(req, send)
+    return await send(req)
+
+
+def upstream_chunks(
+    resp: httpx.Response, offered: Iterable[str],
+) -> tuple[AsyncGenerator[bytes, None], str | None]:
+    """The response body as sent, compressed with a codec from `offered`.
+
+    The body is not decoded, so its Content-Encoding and Content-Length
+    headers still hold for what pollux hands to the client.
+    """
+    chunks = count_bytes(resp.aiter_raw(), "castor", "upstream", "in")
+    codec = choose_codec(offered, config.tunnel_compression)
+    return maybe_compress(chunks, codec, "response", resp.headers)
+
+
+def request_body(
+    content: AsyncGenerator[bytes, None], codec: str | None,
+) -> AsyncGenerator[bytes, None]:
+    return decompress_stream(content, codec) if codec else content
 
 
 async def get_request_session(
-    db_session: Session = Depends(get_session),
+    storage: Storage = Depends(get_storage),
     x_csrf_token: str = Header(""),  # request session id
 ) -> RequestSession:
-    for _ in range(16):
-        req_session = await read_request_session(db_session, x_csrf_token)
-        if req_session is not None:
-            break
-        await asyncio.sleep(0.1)
-
-    else:
-        logger.warning(f"{x_csrf_token=}")
+    with session_events.watch(x_csrf_token) as ready:
+        req_session = await wait_until(
+            lambda: storage.read_request_session(x_csrf_token),
+            ready,
+            config.session_wait_timeout,
+            event_poll_interval,
+        )
+
+    if req_session is None:
+        logger.warning("x_csrf_token=%r", x_csrf_token)
         raise HTTPException(status.HTTP_404_NOT_FOUND, detail="QQ Not Found")
 
     return req_session
@@ -50,25 +142,79 @@ async def get_request_session(
 
 @app.on_event("startup")
 async def startup_event() -> None:
+    global reaper_task
+
     setup_logger()
-    await init_db()
+    if error := shared_state_error(config.workers):
+        raise RuntimeError(f"cannot run {config.workers} castor workers: {error}")
+    if config.storage_backend == "sql":
+        await init_db()
+    if config.reaper_interval > 0:
+        reaper_task = asyncio.create_task(
+            reap_expired_sessions(config.reaper_interval, config.reaper_batch_size)
+        )
+
+
+@app.on_event("shutdown")
+async def shutdown_event() -> None:
+    if reaper_task is not None:
+        reaper_task.cancel()
+        await asyncio.gather(reaper_task, return_exceptions=True)
+    await coalescer.aclose()
+    await close_upstream_client()
+    close_response_cache()
+
+
+@app.exception_handler(StorageFull)
+async def storage_full_handler(request: Request, exc: StorageFull) -> JSONResponse:
+    logger.warning("Storage Full - %s", exc)
+    return JSONResponse(
+        {"detail": "QQ Insufficient Storage"},
+        status_code=status.HTTP_507_INSUFFICIENT_STORAGE,
+    )
 
 
-@app.get("/hello")
-async def ask_new_request_session(db_session: Session = Depends(get_session)) -> Any:
-    req_session = await create_request_session(db_session)
+@app.get("/metrics")
+async def get_metrics() -> Response:
+    return Response(render(), media_type=CONTENT_TYPE)
+
 
+@app.get("/hello")
+async def ask_new_request_session(
+    storage: Storage = Depends(get_storage),
+    k: int | None = Query(None, ge=1, le=100),  # session_count
+) -> Any:
+    if k is None:
+        req_session = await storage.create_request_session()
+        session_events.notify(req_session.id)
+
+        potato = Potato(config.secert)
+        return {
+            "result": 1,
+            "token": req_session.id,
+            "data": potato.pack_str(req_session.secret),
+        }
+
+    # a batch for pollux's session pool, with each session's lifetime
     potato = Potato(config.secert)
-    return {
-        "result": 1,
-        "token": req_session.id,
-        "data": potato.pack_str(req_session.secret),
-    }
+    sessions: list[dict[str, Any]] = []
+    for req_session in await storage.create_request_sessions(k):
+        session_events.notify(req_session.id)
+        potato.reset()
+        sessions.append(
+            {
+                "token": req_session.id,
+                "data": potato.pack_str(req_session.secret),
+                "e": config.session_ttl,
+            }
+        )
+
+    return {"result": 1, "data": sessions}
 
 
 @app.get("/ai")
 async def add_header(
-    db_session: Session = Depends(get_session),
+    storage: Storage = Depends(get_storage),
     req_session: RequestSession = Depends(get_request_session),
     x: str = Query(...),  # encrypted_name
     y: str = Query(...),  # encrypted_value
@@ -76,23 +222,71 @@ async def add_header(
     potato = Potato(req_session.secret)
     name = potato.unpack_str(x)
     value = potato.unpack_str(y)
-    logger.info(f"[{req_session.id}] Add Header - {name=} {value=}")
+    logger.info("[%s] Add Header - name=%r value=%r", req_session.id, name, value)
+
+    await storage.create_request_header(req_session.id, name, value)
+
+    return {"result": 1, "data": []}
+
+
+@app.post("/ai")
+async def add_headers(
+    storage: Storage = Depends(get_storage),
+    req_session: RequestSession = Depends(get_request_session),
+    x: list[tuple[str, str]] = Body(..., embed=True),  # encrypted_headers
+) -> Any:
+    potato = Potato(req_session.secret)
+    headers: list[tuple[str, str]] = []
+    for encrypted_name, encrypted_value in x:
+        potato.reset()
+        name = potato.unpack_str(encrypted_name)
+        value = potato.unpack_str(encrypted_value)
+        logger.info("[%s] Add Header - name=%r value=%r", req_session.id, name, value)
+        headers.append((name, value))
 
-    await create_request_header(db_session, req_session.id, name, value)
+    await storage.create_request_headers(req_session.id, headers)
 
     return {"result": 1, "data": []}
 
 
 @app.get("/ml")
 async def add_body(
-    db_session: Session = Depends(get_session),
+    storage: Storage = Depends(get_storage),
     req_session: RequestSession = Depends(get_request_session),
     i: int = Query(..., min=0),  # index
     j: str = Query(...),  # encrypted_body
 ) -> Any:
-    logger.info(f"[{req_session.id}] Add Body - {i=} {j=}")
+    logger.info("[%s] Add Body - i=%r j=%r", req_session.id, i, j)
+
+    await storage.create_or_update_request_body(req_session.id, i, j)
+
+    return {"result": 1, "data": []}
+
+
+@app.post("/ml")
+async def add_body_stream(
+    request: Request,
+    storage: Storage = Depends(get_storage),
+    req_session: RequestSession = Depends(get_request_session),
+    c: str | None = Query(None, regex="^(deflate|zstd)$"),  # body_codec
+) -> Any:
+    decoder = PotatoDecoder(req_session.secret)
 
-    await create_or_update_request_body(db_session, req_session.id, i, j)
+    async def decoded() -> AsyncGenerator[bytes, None]:
+        async for chunk in request.stream():
+            if data := decoder.update(chunk):
+                yield data
+        yield decoder.flush()
+
+    # Re-pack into the same rows the chunked `/ml` upload would have stored.
+    potato = Potato(req_session.secret)
+    values: list[str] = []
+    body_stream = request_body(decoded(), c)
+    async for body in stream_views(body_stream, chunk_size=config.chunk_size * 3):
+        values.append(potato.pack_bytes(body).decode())
+    logger.info("[%s] Add Body - %s chunks", req_session.id, len(values))
+
+    await storage.create_request_bodies(req_session.id, values)
 
     return {"result": 1, "data": []}
 
@@ -100,73 +294,262 @@ async def add_body(
 @app.get("/text")
 async def do_request(
     background_tasks: BackgroundTasks,
-    db_session: Session = Depends(get_session),
-    client: httpx.AsyncClient = Depends(get_http_client),
+    storage: Storage = Depends(get_storage),
+    client: httpx.AsyncClient = Depends(upstream_client_dependency),
     req_session: RequestSession = Depends(get_request_session),
     m: str = Query(...),  # encrypted_method
     n: str = Query(...),  # encrypted_url
+    k: int | None = Query(None, ge=0),  # body_chunk_count
+    h: bool = Query(False),  # send status and headers in-band
+    z: str = Query(""),  # codecs pollux accepts, comma separated
 ) -> Any:
     potato = Potato(req_session.secret)
     method = potato.unpack_str(m)
     url = potato.unpack_str(n)
 
-    headers: list[tuple[str, str]] = []
-    for req_header in await read_request_headers(db_session, req_session.id):
-        if req_header.name.lower() == "accept-encoding":
-            headers.append(("accept-encoding", ""))
-        else:
-            headers.append((req_header.name, req_header.value))
-
-    potato.reset()
-    body = b""
-    for req_body in await read_request_bodies(db_session, req_session.id):
-        body += potato.unpack_bytes(req_body.value.encode())
-
-    logger.info(f"[{req_session.id}] Do Request - {method} {url}\n{headers=}\n{body=}")
+    headers = upstream_headers(
+        (req_header.name, req_header.value)
+        for req_header in await storage.read_request_headers(req_session.id)
+    )
 
-    req = client.build_request(method, url, headers=headers, content=body)
-    resp = await client.send(req, stream=True)
+    indexes = await storage.read_request_body_indexes(req_session.id)
+    if k is not None and indexes != list(range(k)):
+        logger.warning("[%s] Incomplete Body - k=%r", req_session.id, k)
+        await storage.delete_request_session(req_session.id)
+        raise HTTPException(status.HTTP_409_CONFLICT, detail="QQ Conflict")
 
-    await create_response_header(
-        db_session, req_session.id, "@@status_code", str(resp.status_code)
+    async def body() -> AsyncGenerator[bytes, None]:
+        potato.reset()
+        async for req_body in storage.iter_request_bodies(
+            req_session.id, config.body_page_size
+        ):
+            yield potato.unpack_bytes(req_body.value.encode())
+
+    logger.info(
+        "[%s] Do Request - %s %s\nheaders=%r\nbody=%s chunks",
+        req_session.id,
+        method,
+        url,
+        headers,
+        len(indexes),
     )
 
-    for name, value in resp.headers.items():
-        logger.info(f"Response Header: {name=} {value=}")
-        await create_response_header(db_session, req_session.id, name, value)
+    # Without a Content-Length from the client the body goes out chunked.
+    content = body() if indexes else None
+    try:
+        resp = await send_upstream(client, method, url, headers, content)
+    except Exception:
+        # neither the h=1 cleanup nor /home would ever run for this session
+        await storage.delete_request_session(req_session.id)
+        raise
+    chunks, codec = upstream_chunks(resp, z.split(","))
+
+    head = b""
+    if h:
+        # the status and headers lead the body, so pollux never calls /home
+        metadata = {"i": resp.status_code, "x": resp.headers.multi_items(), "z": codec}
+        logger.info("Response Header: metadata=%r", metadata)
+        head = pack_frame(
+            FrameType.HEADER, json.dumps(metadata).encode(), Potato(req_session.secret)
+        )
+    else:
+        resp_headers = [("@@status_code", str(resp.status_code))]
+        if codec:
+            resp_headers.append(("@@encoding", codec))
+        for name, value in resp.headers.items():
+            logger.info("Response Header: name=%r value=%r", name, value)
+            resp_headers.append((name, value))
+        await storage.create_response_headers(req_session.id, resp_headers)
+        response_events.notify(req_session.id)
 
     async def stream() -> AsyncGenerator[bytes, None]:
-        potato.reset()
-        async for chunk in resp.aiter_bytes(chunk_size=config.chunk_size * 3):
-            yield potato.pack_bytes(chunk)
+        if head:
+            yield head
+        encoder = PotatoEncoder(req_session.secret)
+        async for chunk in chunks:
+            if data := encoder.update(chunk):
+                yield data
+        yield encoder.flush()
 
     background_tasks.add_task(resp.aclose)
-    background_tasks.add_task(delete_request_session, db_session, req_session.id)
+    if h:
+        background_tasks.add_task(storage.delete_request_session, req_session.id)
     return StreamingResponse(stream(), media_type="text/plain")
 
 
 @app.get("/home")
 async def get_response_headers(
-    db_session: Session = Depends(get_session),
+    background_tasks: BackgroundTasks,
+    storage: Storage = Depends(get_storage),
     req_session: RequestSession = Depends(get_request_session),
 ) -> Any:
+    with response_events.watch(req_session.id) as ready:
+        resp_headers = await wait_until(
+            lambda: storage.read_response_headers(req_session.id),
+            ready,
+            config.response_wait_timeout,
+            event_poll_interval,
+        )
+
     potato = Potato(req_session.secret)
     status_code = 200
+    codec = None
     headers: list[tuple[str, str]] = []
-    for header in await read_response_headers(db_session, req_session.id):
+    for header in resp_headers:
         name = header.name
         value = header.value
-        logger.debug(f"Response Header: {name=} {value=}")
+        logger.debug("Response Header: name=%r value=%r", name, value)
         if name == "@@status_code":
             try:
                 status_code = int(value)
             except:
                 pass
+        elif name == "@@encoding":
+            codec = value
         else:
             potato.reset()
             headers.append((potato.pack_str(name), potato.pack_str(value)))
 
+    # pollux asks for the headers last, so the session is done with here
+    if resp_headers:
+        background_tasks.add_task(storage.delete_request_session, req_session.id)
     return {
         "result": 1,
-        "data": {"x": headers, "i": status_code},
+        "data": {"x": headers, "i": status_code, "z": codec},
     }
+
+
+@app.post("/talk")
+async def do_tunnel_request(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    client: httpx.AsyncClient = Depends(upstream_client_dependency),
+) -> Any:
+    """One exchange per proxied request, see `gemini.core.frame`.
+
+    The request body carries HELLO, HEADER, BODY... and END frames; the
+    response carries HEADER, BODY... and END frames.
+    """
+    reader = FrameReader(request.stream(), Potato(config.secert))
+    try:
+        hello = await reader.read()
+        if hello is None or hello[0] != FrameType.HELLO:
+            raise FrameError("expected a HELLO frame")
+        secret = hello[1].decode()
+        reader.potato = Potato(secret)
+
+        head = await reader.read()
+        if head is None or head[0] != FrameType.HEADER:
+            raise FrameError("expected a HEADER frame")
+        metadata = json.loads(head[1])
+        method, url = metadata["m"], metadata["n"]
+        headers = upstream_headers(metadata["x"])
+    except (FrameError, ValueError, KeyError) as e:
+        logger.warning("Bad Tunnel Request - %r", e)
+        raise HTTPException(status.HTTP_404_NOT_FOUND, detail="QQ Not Found")
+
+    async def body() -> AsyncGenerator[bytes, None]:
+        while (frame := await reader.read()) is not None:
+            kind, payload = frame
+            if kind == FrameType.END:
+                return
+            yield payload
+        raise FrameError("request stream ended without an END frame")
+
+    logger.info("Do Tunnel Request - %s %s\nheaders=%r", method, url, headers)
+
+    content: AsyncGenerator[bytes, None] | None = None
+    if metadata.get("b"):
+        content = request_body(body(), metadata.get("c"))
+    else:
+        # Drain the END frame, upstream gets no body at all.
+        async for _ in body():
+            pass
+
+    resp = await send_upstream(client, method, url, headers, content)
+    chunks, codec = upstream_chunks(resp, metadata.get("z", ()))
+
+    async def stream() -> AsyncGenerator[bytes, None]:
+        potato = Potato(secret)
+        metadata = {"i": resp.status_code, "x": resp.headers.multi_items(), "z": codec}
+        yield pack_frame(FrameType.HEADER, json.dumps(metadata).encode(), potato)
+        async for chunk in chunks:
+            yield pack_frame(FrameType.BODY, chunk, potato)
+        yield pack_frame(FrameType.END, b"", potato)
+
+    background_tasks.add_task(resp.aclose)
+    return StreamingResponse(stream(), media_type="application/octet-stream")
+
+
+async def serve_mux_stream(client: httpx.AsyncClient, stream: MuxStream) -> None:
+    try:
+        _, head = await stream.receive()
+        metadata = json.loads(head)
+        method, url = metadata["m"], metadata["n"]
+        headers = upstream_headers(metadata["x"])
+        logger.info(
+            "[mux %s] Do Request - %s %s\nheaders=%r", stream.id, method, url, headers
+        )
+
+        content = None
+        if metadata.get("b"):
+            content = request_body(stream.body(), metadata.get("c"))
+        else:
+            await stream.receive()  # END
+
+        resp = await send_upstream(client, method, url, headers, content)
+        try:
+            chunks, codec = upstream_chunks(resp, metadata.get("z", ()))
+            metadata = {
+                "i": resp.status_code,
+                "x": resp.headers.multi_items(),
+                "z": codec,
+            }
+            await stream.send(FrameType.HEADER, json.dumps(metadata).encode())
+            async for chunk in chunks:
+                await stream.send(FrameType.BODY, chunk)
+            await stream.send(FrameType.END)
+        finally:
+            await resp.aclose()
+
+    except StreamReset as e:
+        logger.info("[mux %s] Reset - %s", stream.id, e)
+    except Exception as e:
+        logger.warning("[mux %s] Request Failed - %r", stream.id, e)
+    finally:
+        await stream.close("request failed")
+
+
+@app.websocket("/live")
+async def live_tunnel(
+    websocket: WebSocket,
+    client: httpx.AsyncClient = Depends(upstream_client_dependency),
+) -> None:
+    """Persistent tunnel carrying many requests as `gemini.core.mux` streams."""
+    await websocket.accept()
+    try:
+        conn = MuxConnection.from_hello(
+            await websocket.receive_bytes(),
+            config.secert,
+            websocket.send_bytes,
+            max_streams=config.mux_max_streams,
+        )
+    except Exception as e:
+        logger.warning("Bad Mux Hello - %r", e)
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    tasks: set[asyncio.Task[None]] = set()
+    try:
+        while True:
+            stream = await conn.feed(await websocket.receive_bytes())
+            if stream is not None:
+                stream.task = asyncio.create_task(serve_mux_stream(client, stream))
+                tasks.add(stream.task)
+                stream.task.add_done_callback(tasks.discard)
+    except WebSocketDisconnect:
+        logger.info("Mux Disconnected")
+    finally:
+        conn.close()
+        for task in tasks:
+            task.cancel()
@@ -1,74 +1,341 @@
 import asyncio
+import json
 import logging
+import secrets
+from itertools import count
 from typing import Any, AsyncGenerator
 
 import httpx
 from anyio import CapacityLimiter
 from anyio.lowlevel import RunVar
-from fastapi import BackgroundTasks, FastAPI
+from fastapi import BackgroundTasks, FastAPI, status
+from fastapi.exceptions import HTTPException
 from fastapi.param_functions import Depends
 from fastapi.requests import Request
-from fastapi.responses import StreamingResponse
+from fastapi.responses import Response, StreamingResponse
 
 from gemini.config import config
-from gemini.core.potato import Potato
-from gemini.http import get_http_client
+from gemini.core.compress import (
+    REQUEST_CODEC,
+    available_codecs,
+    decompress_stream,
+    maybe_compress,
+)
+from gemini.core.frame import FrameError, FrameReader, FrameType, pack_frame
+from gemini.core.potato import Potato, PotatoDecoder, PotatoEncoder
+from gemini.core.mux import StreamReset
+from gemini.http import (
+    castor_client_dependency,
+    close_castor_client,
+    close_mux_client,
+    close_session_pool,
+    get_mux_client,
+    get_session_pool,
+)
 from gemini.logger import setup_logger
-from gemini.utils import stream_reader
+from gemini.metrics import (
+    CONTENT_TYPE,
+    EndpointMetrics,
+    PhaseTimer,
+    count_bytes,
+    render,
+)
+from gemini.utils import stream_views
 
 logger = logging.getLogger("gemini.pollux")
 app = FastAPI(debug=config.debug)
+app.add_middleware(EndpointMetrics, server="pollux")
 
 
 @app.on_event("startup")
 async def startup_event() -> None:
     # RunVar("_default_thread_limiter").set(CapacityLimiter(2))
     setup_logger()
+    if config.tunnel_mode == "legacy" and config.session_pool_size > 0:
+        get_session_pool().start()
+
+
+@app.on_event("shutdown")
+async def shutdown_event() -> None:
+    await close_session_pool()
+    await close_castor_client()
+    await close_mux_client()
+
+
+def forward_headers(request: Request) -> list[tuple[str, str]]:
+    headers: list[tuple[str, str]] = []
+    for name, value in request.headers.items():
+        if name.lower().startswith("x-forwarded"):
+            continue
+        if name.lower() == "accept-encoding" and not config.pass_encoded:
+            continue
+
+        logger.info("Request Header: name=%r value=%r", name, value)
+        headers.append((name, value))
+
+    return headers
+
+
+def is_own_address(request: Request) -> bool:
+    """Whether `request` is for pollux itself rather than to be proxied."""
+    host, port = request.scope.get("server") or (config.host, config.port)
+    local = {host, config.host, "localhost", "127.0.0.1", "::1"}
+    default_port = 443 if request.url.scheme == "https" else 80
+    return request.url.hostname in local and (request.url.port or default_port) == port
+
+
+def client_body(request: Request) -> AsyncGenerator[bytes, None]:
+    return count_bytes(request.stream(), "pollux", "client", "in")
+
+
+def upload_body(request: Request) -> tuple[AsyncGenerator[bytes, None], str | None]:
+    """The client's body, compressed for the tunnel when that pays off."""
+    codec = REQUEST_CODEC if config.tunnel_compression != "none" else None
+    return maybe_compress(client_body(request), codec, "request", request.headers)
+
+
+def accepted_codecs() -> list[str]:
+    return available_codecs(config.tunnel_compression)
+
+
+def has_body(request: Request) -> bool:
+    content_length = request.headers.get("content-length", "0")
+    return "transfer-encoding" in request.headers or content_length != "0"
+
+
+def tunnel_metadata(request: Request, codec: str | None) -> dict[str, Any]:
+    return {
+        "m": request.method,
+        "n": str(request.url),
+        "x": forward_headers(request),
+        "b": has_body(request),
+        "c": codec,
+        "z": accepted_codecs(),
+    }
+
+
+def tunnel_response(
+    body: AsyncGenerator[bytes, None], metadata: dict[str, Any]
+) -> StreamingResponse:
+    if codec := metadata.get("z"):
+        body = decompress_stream(body, codec)
+
+    headers: list[tuple[bytes, bytes]] = []
+    for name, value in metadata["x"]:
+        logger.info("Response Header: name=%r value=%r", name, value)
+        headers.append((name.lower().encode("latin-1"), value.encode("latin-1")))
+
+    streaming_resp = StreamingResponse(
+        count_bytes(body, "pollux", "client", "out"), status_code=metadata["i"]
+    )
+    streaming_resp.raw_headers = headers
+    return streaming_resp
+
+
+async def tunnel_request(
+    request: Request, background_tasks: BackgroundTasks, client: httpx.AsyncClient,
+) -> StreamingResponse:
+    """Proxy `request` through castor's `/talk` in a single exchange."""
+    session_secret = secrets.token_urlsafe(24)
+    potato = Potato(session_secret)
+    content, codec = upload_body(request)
+    metadata = tunnel_metadata(request, codec)
+
+    async def frames() -> AsyncGenerator[bytes, None]:
+        hello = session_secret.encode()
+        yield pack_frame(FrameType.HELLO, hello, Potato(config.secert))
+        yield pack_frame(FrameType.HEADER, json.dumps(metadata).encode(), potato)
+        if metadata["b"]:
+            async for chunk in content:
+                if chunk:
+                    yield pack_frame(FrameType.BODY, chunk, potato)
+        yield pack_frame(FrameType.END, b"", potato)
+
+    req = client.build_request(
+        "POST", f"{config.castor_url_base}/talk", content=frames()
+    )
+    resp = await client.send(req, stream=True)
+    reader = FrameReader(resp.aiter_bytes(), Potato(session_secret))
+    head = await reader.read() if resp.status_code == status.HTTP_200_OK else None
+    if head is None or head[0] != FrameType.HEADER:
+        await resp.aclose()
+        logger.error("Castor Error - %s", resp.status_code)
+        raise HTTPException(status.HTTP_502_BAD_GATEWAY)
+
+    async def stream() -> AsyncGenerator[bytes, None]:
+        while (frame := await reader.read()) is not None:
+            kind, payload = frame
+            if kind == FrameType.END:
+                return
+            yield payload
+        raise FrameError("castor stream ended without an END frame")
+
+    background_tasks.add_task(resp.aclose)
+    return tunnel_response(stream(), json.loads(head[1]))
+
+
+async def mux_request(request: Request) -> StreamingResponse:
+    """Proxy `request` as a stream of castor's persistent `/live` tunnel."""
+    try:
+        stream = await get_mux_client().open_stream()
+    except StreamReset as e:
+        logger.error("Castor Error - %s", e)
+        raise HTTPException(status.HTTP_502_BAD_GATEWAY)
+
+    try:
+        content, codec = upload_body(request)
+        metadata = tunnel_metadata(request, codec)
+        await stream.send(FrameType.HEADER, json.dumps(metadata).encode())
+        if metadata["b"]:
+            async for chunk in content:
+                if chunk:
+                    await stream.send(FrameType.BODY, chunk)
+        await stream.send(FrameType.END)
+        _, head = await stream.receive()
+    except StreamReset as e:
+        await stream.close()
+        logger.error("Castor Error - %s", e)
+        raise HTTPException(status.HTTP_502_BAD_GATEWAY)
+    except BaseException:
+        await stream.close()
+        raise
+
+    async def body() -> AsyncGenerator[bytes, None]:
+        try:
+            async for chunk in stream.body():
+                yield chunk
+        finally:
+            await stream.close()
+
+    return tunnel_response(body(), json.loads(head))
+
+
+async def upload_body_chunks(
+    client: httpx.AsyncClient,
+    session_id: str,
+    potato: Potato,
+    stream: AsyncGenerator[bytes, None],
+    window: int,
+) -> int:
+    """Upload `stream` as indexed `/ml` chunks, `window` requests at a time.
+
+    Chunks are encrypted in order, so castor can replay them by index no
+    matter in which order the uploads finish. Returns the number of chunks.
+    """
+    slots = asyncio.Semaphore(window)
+
+    async def send(index: int, encrypted_body: str) -> None:
+        try:
+            for attempt in count():
+                try:
+                    resp = await client.get(
+                        f"{config.castor_url_base}/ml",
+                        headers={"X-CSRF-Token": session_id},
+                        params={"i": index, "j": encrypted_body},
+                    )
+                    resp.raise_for_status()
+                    return
+                except httpx.HTTPError as e:
+                    if attempt >= config.upload_retries:
+                        raise
+                    logger.warning(
+                        "Retry Body - index=%r attempt=%r %r", index, attempt, e
+                    )
+        finally:
+            slots.release()
+
+    index = 0
+    async with asyncio.TaskGroup() as tg:
+        async for body in stream_views(stream, chunk_size=config.upload_chunk_size):
+            await slots.acquire()
+            tg.create_task(send(index, potato.pack_bytes(body).decode()))
+            index += 1
+
+    return index
 
 
 @app.api_route("/{path:path}", methods=["HEAD", "GET", "POST"])
 async def root_route(
     request: Request,
     background_tasks: BackgroundTasks,
-    client: httpx.AsyncClient = Depends(get_http_client),
+    client: httpx.AsyncClient = Depends(castor_client_dependency),
 ) -> Any:
-    logger.info(f"{request.method} {request.url}")
+    if request.url.path == "/metrics" and is_own_address(request):
+        return Response(render(), media_type=CONTENT_TYPE)
 
-    resp = await client.get(f"{config.castor_url_base}/hello")
-    session_data = resp.json()
+    logger.info("%s %s", request.method, request.url)
+    timer = PhaseTimer("pollux")
 
-    potato = Potato(config.secert)
-    session_id = session_data["token"]
-    session_secret = potato.unpack_str(session_data["data"])
-    logger.info(f"{session_id=} {session_secret=}")
+    if config.tunnel_mode in ("frame", "websocket"):
+        if config.tunnel_mode == "frame":
+            tunnel_resp = await tunnel_request(request, background_tasks, client)
+        else:
+            tunnel_resp = await mux_request(request)
+        timer.lap(config.tunnel_mode)
+        timer.done()
+        return tunnel_resp
 
-    potato = Potato(session_secret)
-    for name, value in request.headers.items():
-        if name.lower().startswith("x-forwarded"):
-            continue
-        if name.lower() == "accept-encoding":
-            continue
+    if config.session_pool_size > 0:
+        session_id, session_secret, _ = await get_session_pool().get()
+    else:
+        resp = await client.get(f"{config.castor_url_base}/hello")
+        session_data = resp.json()
+
+        potato = Potato(config.secert)
+        session_id = session_data["token"]
+        session_secret = potato.unpack_str(session_data["data"])
+    logger.info("session_id=%r session_secret=%r", session_id, session_secret)
+    timer.lap("hello")
 
-        logger.info(f"Request Header: {name=} {value=}")
+    potato = Potato(session_secret)
+    encrypted_headers: list[tuple[str, str]] = []
+    for name, value in forward_headers(request):
         potato.reset()
         encrypted_name = potato.pack_str(name)
         encrypted_value = potato.pack_str(value)
-        resp = await client.get(
+        encrypted_headers.append((encrypted_name, encrypted_value))
+
+    if config.batch_headers:
+        resp = await client.post(
             f"{config.castor_url_base}/ai",
             headers={"X-CSRF-Token": session_id},
-            params={"x": encrypted_name, "y": encrypted_value},
+            json={"x": encrypted_headers},
         )
+    else:
+        for encrypted_name, encrypted_value in encrypted_headers:
+            resp = await client.get(
+                f"{config.castor_url_base}/ai",
+                headers={"X-CSRF-Token": session_id},
+                params={"x": encrypted_name, "y": encrypted_value},
+            )
 
-    potato.reset()
-    index = 0
-    async for body in stream_reader(request.stream(), chunk_size=128):
-        encrypted_body = potato.pack_bytes(body).decode()
-        resp = await client.get(
+    timer.lap("headers")
+
+    body_chunks: int | None = None
+    if config.upload_mode == "stream" and has_body(request):
+        content, codec = upload_body(request)
+
+        async def upload() -> AsyncGenerator[bytes, None]:
+            encoder = PotatoEncoder(session_secret)
+            async for chunk in content:
+                if data := encoder.update(chunk):
+                    yield data
+            yield encoder.flush()
+
+        resp = await client.post(
             f"{config.castor_url_base}/ml",
             headers={"X-CSRF-Token": session_id},
-            params={"i": index, "j": encrypted_body},
+            params={"c": codec} if codec else None,
+            content=upload(),
         )
-        index += 1
+    elif config.upload_mode in ("chunk", "pipeline"):
+        potato.reset()
+        window = config.upload_window if config.upload_mode == "pipeline" else 1
+        body_chunks = await upload_body_chunks(
+            client, session_id, potato, client_body(request), window
+        )
+
+    timer.lap("body")
 
     # =============================================================
 
@@ -109,15 +376,49 @@ async def root_route(
     potato.reset()
     encrypted_method = potato.pack_str(request.method)
     encrypted_url = potato.pack_str(str(request.url))
+    params: dict[str, str | int] = {"m": encrypted_method, "n": encrypted_url}
+    if body_chunks is not None:
+        params["k"] = body_chunks
+    if config.inband_headers:
+        params["h"] = 1
+    if codecs := accepted_codecs():
+        params["z"] = ",".join(codecs)
     req = client.build_request(
         "GET",
         f"{config.castor_url_base}/text",
         headers={"X-CSRF-Token": session_id},
-        params={"m": encrypted_method, "n": encrypted_url},
+        params=params,
     )
     resp = await client.send(req, stream=True)
+    if resp.status_code != status.HTTP_200_OK:
+        await resp.aclose()
+        logger.error("Castor Error - %s", resp.status_code)
+        raise HTTPException(status.HTTP_502_BAD_GATEWAY)
+    timer.lap("text")
+
+    if config.inband_headers:
+        reader = FrameReader(resp.aiter_bytes(), Potato(session_secret))
+        try:
+            head = await reader.read()
+        except (FrameError, ValueError):
+            head = None
+        if head is None or head[0] != FrameType.HEADER:
+            await resp.aclose()
+            logger.error("Castor Error - missing response metadata")
+            raise HTTPException(status.HTTP_502_BAD_GATEWAY)
+
+        async def inband_stream() -> AsyncGenerator[bytes, None]:
+            decoder = PotatoDecoder(session_secret)
+            async for chunk in reader.remainder():
+                if data := decoder.update(chunk):
+                    yield data
+            yield decoder.flush()
+
+        background_tasks.add_task(resp.aclose)
+        timer.lap("metadata")
+        timer.done()
+        return tunnel_response(inband_stream(), json.loads(head[1]))
 
-    await asyncio.sleep(0.25)
     meta_resp = await client.get(
         f"{config.castor_url_base}/home", headers={"X-CSRF-Token": session_id}
     )
@@ -127,17 +428,25 @@ async def root_route(
         potato.reset()
         name = potato.unpack_str(encrypted_name)
         value = potato.unpack_str(encrypted_value)
-        logger.info(f"Response Header: {name=} {value=}")
+        logger.info("Response Header: name=%r value=%r", name, value)
         headers.append((name.lower().encode("latin-1"), value.encode("latin-1")))
 
     async def stream() -> AsyncGenerator[bytes, None]:
-        potato.reset()
-        async for chunk in resp.aiter_bytes(chunk_size=config.chunk_size * 4):
-            d = potato.unpack_bytes(chunk)
-            yield d
+        decoder = PotatoDecoder(session_secret)
+        async for chunk in resp.aiter_bytes():
+            if data := decoder.update(chunk):
+                yield data
+        yield decoder.flush()
+
+    body = stream()
+    if codec := metadata.get("z"):
+        body = decompress_stream(body, codec)
 
     background_tasks.add_task(resp.aclose)
-    background_tasks.add_task(client.aclose)
-    streaming_resp = StreamingResponse(stream(), status_code=metadata["i"])
+    timer.lap("metadata")
+    timer.done()
+    streaming_resp = StreamingResponse(
+        count_bytes(body, "pollux", "client", "out"), status_code=metadata["i"]
+    )
     streaming_resp.raw_headers = headers
     return streaming_resp
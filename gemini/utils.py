@@ -1,15 +1,39 @@
-from typing import AsyncGenerator
+from typing import AsyncGenerator, AsyncIterator
 
 
-async def stream_reader(
-    stream: AsyncGenerator[bytes, None], chunk_size: int = 128,
-) -> AsyncGenerator[bytes, None]:
-    body = b""
+async def stream_views(
+    stream: AsyncIterator[bytes], chunk_size: int = 128,
+) -> AsyncGenerator[memoryview, None]:
+    """Re-chunk `stream` into `chunk_size` pieces, the last one possibly shorter.
+
+    Pieces that lie within one incoming chunk are views of it, and only the
+    pieces that straddle two chunks are copied, once, into a fresh buffer.
+    A view is only valid until the next piece is asked for.
+    """
+    pending = bytearray()
     async for chunk in stream:
-        body += chunk
-        while len(body) >= chunk_size:
-            yield body[:chunk_size]
-            body = body[chunk_size:]
+        with memoryview(chunk) as view:
+            start = 0
+            if pending:
+                start = min(chunk_size - len(pending), len(view))
+                pending += view[:start]
+                if len(pending) < chunk_size:
+                    continue
+                yield memoryview(pending)
+                pending = bytearray()  # the consumer may still hold a view
+
+            end = start + chunk_size
+            while end <= len(view):
+                yield view[start:end]
+                start, end = end, end + chunk_size
+            pending += view[start:]
 
-    if len(body) > 0:
-        yield body
+    if pending:
+        yield memoryview(pending)
+
+
+async def stream_reader(
+    stream: AsyncIterator[bytes], chunk_size: int = 128,
+) -> AsyncGenerator[bytes, None]:
+    async for piece in stream_views(stream, chunk_size):
+        yield bytes(piece)
@@ -1,14 +1,21 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
 import logging
 
 import uvicorn
 
 from gemini.config import config
+from gemini.database import get_engine, init_db, shared_state_error
 from gemini.logger import setup_logger
 
 
+async def create_tables() -> None:
+    await init_db()
+    await get_engine().dispose()
+
+
 def main() -> None:
     setup_logger()
 
@@ -16,14 +23,23 @@ def main() -> None:
     parser.add_argument("server", help="server name", choices=["castor", "pollux"])
     args = parser.parse_args()
 
+    workers = config.workers
+    if args.server == "castor" and workers > 1:
+        if error := shared_state_error(workers):
+            parser.error(f"cannot run {workers} castor workers: {error}")
+        if config.storage_backend == "sql":
+            asyncio.run(create_tables())  # once, before the workers race to it
+
+    # uvicorn ignores `workers` when reloading
+    reload = config.env == "development" and workers == 1
     uvicorn.run(
         f"gemini.servers.{args.server}:app",
         host=config.host,
         port=config.port,
         log_level=logging.DEBUG if config.debug else logging.INFO,
-        reload=True if config.env == "development" else False,
-        reload_dirs=["gemini"],
-        workers=1,
+        reload=reload,
+        reload_dirs=["gemini"] if reload else None,
+        workers=workers,
         log_config=None,
         proxy_headers=True,
     )
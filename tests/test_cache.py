@@ -0,0 +1,76 @@
+import asyncio
+from pathlib import Path
+from typing import AsyncIterator
+
+import httpx
+
+from gemini.core.cache import ResponseCache
+
+URL = "http://upstream/a"
+BODY = b"potato" * 1000
+
+
+class Body(httpx.AsyncByteStream):
+    # streamed as from the network, where `content=` would be read already
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        yield BODY
+
+
+def fetch_twice(
+    cache: ResponseCache, handler: httpx.MockTransport, second: dict[str, str],
+) -> tuple[httpx.Response, bytes]:
+    async def main() -> tuple[httpx.Response, bytes]:
+        async with httpx.AsyncClient(transport=handler) as client:
+
+            async def send(request: httpx.Request) -> httpx.Response:
+                return await client.send(request, stream=True)
+
+            resp = await cache.send(client.build_request("GET", URL), send)
+            await resp.aread()
+            request = client.build_request("GET", URL, headers=second)
+            resp = await cache.send(request, send)
+            return resp, await resp.aread()
+
+    return asyncio.run(main())
+
+
+def test_revalidated_entry_evicted_meanwhile(tmp_path: Path) -> None:
+    cache = ResponseCache(1 << 20, 1 << 20, str(tmp_path), 1 << 20, disk_threshold=0)
+    conditional: list[bool] = []
+
+    def handle(request: httpx.Request) -> httpx.Response:
+        conditional.append("if-none-match" in request.headers)
+        if conditional[-1]:
+            # another response pushes the entry, and its file, out meanwhile
+            for key in list(cache._entries):
+                cache._remove(key)
+            return httpx.Response(304, headers={"etag": '"a"'})
+        return httpx.Response(200, headers={"etag": '"a"'}, stream=Body())
+
+    resp, body = fetch_twice(cache, httpx.MockTransport(handle), {})
+
+    assert resp.status_code == 200
+    assert body == BODY
+    assert conditional == [False, True, False]
+
+
+def test_bare_not_modified_keeps_stored_freshness() -> None:
+    cache = ResponseCache(1 << 20, 1 << 20)
+    requests: list[httpx.Request] = []
+
+    def handle(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        if "if-none-match" in request.headers:
+            return httpx.Response(304, headers={"etag": '"a"'})
+        headers = {"etag": '"a"', "cache-control": "max-age=60"}
+        return httpx.Response(200, headers=headers, stream=Body())
+
+    transport = httpx.MockTransport(handle)
+    resp, body = fetch_twice(cache, transport, {"cache-control": "no-cache"})
+    assert (resp.status_code, body) == (200, BODY)
+    assert len(requests) == 2
+
+    # still fresh for the max-age of the stored response
+    resp, body = fetch_twice(cache, transport, {})
+    assert (resp.status_code, body) == (200, BODY)
+    assert len(requests) == 2
@@ -0,0 +1,90 @@
+import asyncio
+from typing import AsyncIterator
+
+import httpx
+import pytest
+
+from gemini.core.coalesce import Coalescer, Diverged, Stalled
+
+CHUNK = 1000
+BODY = b"".join(bytes([i]) * CHUNK for i in range(20))
+
+
+class Body(httpx.AsyncByteStream):
+    def __init__(self, data: bytes):
+        self.data = data
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        for start in range(0, len(self.data), CHUNK):
+            await asyncio.sleep(0.005)
+            yield self.data[start : start + CHUNK]
+
+
+def upstream(bodies: list[bytes]) -> httpx.AsyncClient:
+    """A client answering each request with the next of `bodies`."""
+
+    def handle(request: httpx.Request) -> httpx.Response:
+        data = bodies.pop(0) if len(bodies) > 1 else bodies[0]
+        headers = {"content-length": str(len(data))}
+        return httpx.Response(200, headers=headers, stream=Body(data))
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handle))
+
+
+async def fetch(client: httpx.AsyncClient, request: httpx.Request) -> httpx.Response:
+    return await client.send(request, stream=True)
+
+
+async def read(
+    coalescer: Coalescer, wait: float = 0.0, delay: float = 0.0, stall: float = 0.0,
+) -> bytes:
+    request = httpx.Request("GET", "http://upstream/a")
+    resp = await coalescer.send(request, fetch)
+    await asyncio.sleep(wait)
+    data = b""
+    async for chunk in resp.aiter_raw():
+        data += chunk
+        await asyncio.sleep(delay + stall)
+        stall = 0.0
+    return data
+
+
+def test_slow_and_late_readers_get_whole_bodies() -> None:
+    async def main() -> None:
+        client = upstream([BODY])
+        coalescer = Coalescer(lambda: client, 5 * CHUNK, stall_timeout=10.0)
+        bodies = await asyncio.gather(
+            *(read(coalescer) for _ in range(3)),
+            read(coalescer, delay=0.02),  # falls behind after reading
+            read(coalescer, wait=0.3),  # falls behind before reading, detached
+        )
+        assert bodies == [BODY] * 5
+        await coalescer.aclose()
+
+    asyncio.run(main())
+
+
+def test_detached_refetch_must_match() -> None:
+    async def main() -> None:
+        client = upstream([BODY, BODY[:-1]])
+        coalescer = Coalescer(lambda: client, 5 * CHUNK, stall_timeout=10.0)
+        with pytest.raises(Diverged):
+            await asyncio.gather(read(coalescer), read(coalescer, wait=0.3))
+        await coalescer.aclose()
+
+    asyncio.run(main())
+
+
+def test_stalled_reader_does_not_hold_up_the_flight() -> None:
+    async def main() -> None:
+        client = upstream([BODY])
+        coalescer = Coalescer(lambda: client, 3 * CHUNK, stall_timeout=0.1)
+        fast = asyncio.create_task(read(coalescer))
+        stalled = asyncio.create_task(read(coalescer, stall=1.0))
+
+        assert await asyncio.wait_for(fast, 0.8) == BODY
+        with pytest.raises(Stalled):
+            await stalled
+        await coalescer.aclose()
+
+    asyncio.run(main())
@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+
+from gemini.core.frame import FrameType
+from gemini.core.mux import MuxConnection, MuxStream, StreamReset
+
+
+def connect(window: int) -> tuple[MuxConnection, MuxConnection, list[MuxStream]]:
+    """A client and a server connection wired straight to each other."""
+    accepted: list[MuxStream] = []
+
+    async def to_server(message: bytes) -> None:
+        if (stream := await server.feed(message)) is not None:
+            accepted.append(stream)
+
+    async def to_client(message: bytes) -> None:
+        await client.feed(message)
+
+    client = MuxConnection(to_server, "secret", window, max_streams=4)
+    server = MuxConnection(to_client, "secret", window, 4, accept_streams=True)
+    return client, server, accepted
+
+
+def test_round_trip() -> None:
+    async def main() -> None:
+        client, server, accepted = connect(window=1024)
+        data = bytes(range(256)) * 400
+
+        stream = client.open_stream()
+        await stream.send(FrameType.HEADER, b"{}")
+        (peer,) = accepted
+        assert await peer.receive() == (FrameType.HEADER, b"{}")
+
+        async def read() -> bytes:
+            return b"".join([chunk async for chunk in peer.body()])
+
+        reader = asyncio.create_task(read())
+        await stream.send(FrameType.BODY, data)
+        await stream.send(FrameType.END)
+        assert await asyncio.wait_for(reader, 1) == data
+
+        await peer.send(FrameType.HEADER, b"reply")
+        assert await stream.receive() == (FrameType.HEADER, b"reply")
+
+    asyncio.run(main())
+
+
+def test_streams_and_directions_have_own_keys() -> None:
+    client, server, _ = connect(window=1024)
+    secrets = {
+        client.stream_secret(stream_id, from_client)
+        for stream_id in (1, 3)
+        for from_client in (True, False)
+    }
+    assert len(secrets) == 4
+    assert "secret" not in secrets
+
+
+def test_reset_while_waiting_for_credit() -> None:
+    async def main() -> None:
+        client, server, accepted = connect(window=1024)
+        stream = client.open_stream()
+        await stream.send(FrameType.HEADER, b"{}")
+        (peer,) = accepted
+
+        send = client._send_message
+
+        async def reset_when_out_of_credit(message: bytes) -> None:
+            await send(message)
+            if stream._credit <= 0 and not peer._sent_end:
+                # the peer gives up while the piece that used the credit is sent
+                await peer.close("refused")
+
+        client._send_message = reset_when_out_of_credit
+        with pytest.raises(StreamReset):
+            await asyncio.wait_for(stream.send(FrameType.BODY, bytes(200_000)), 1)
+
+    asyncio.run(main())
@@ -0,0 +1,40 @@
+import random
+
+import pytest
+
+from gemini.core.potato import Potato, PotatoDecoder, PotatoEncoder
+
+KEY = "OTk4MjQ0NTMtZjEyZi00ZjU5LWI3"
+
+
+def split(data: bytes, rng: random.Random) -> list[bytes]:
+    chunks = []
+    while data:
+        size = rng.randint(0, 17)
+        chunks.append(data[:size])
+        data = data[size:]
+    return chunks
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_stream_round_trip(seed: int) -> None:
+    rng = random.Random(seed)
+    data = rng.randbytes(rng.randint(0, 2000))
+
+    encoder = PotatoEncoder(KEY)
+    sealed = b"".join(encoder.update(c) for c in split(data, rng)) + encoder.flush()
+    assert sealed == Potato(KEY).pack_bytes(data)
+
+    decoder = PotatoDecoder(KEY)
+    opened = b"".join(decoder.update(c) for c in split(sealed, rng)) + decoder.flush()
+    assert opened == data
+
+
+def test_truncated_stream() -> None:
+    encoder = PotatoEncoder(KEY)
+    sealed = encoder.update(b"potato") + encoder.flush()
+
+    decoder = PotatoDecoder(KEY)
+    decoder.update(sealed[:5])
+    with pytest.raises(ValueError):
+        decoder.flush()
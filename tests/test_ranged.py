@@ -0,0 +1,85 @@
+import asyncio
+import random
+import re
+from typing import AsyncIterator
+
+import httpx
+
+from gemini.core.ranged import RangedStream, ranged_response
+
+SEGMENT = 8 * 1024
+DATA = random.Random(0).randbytes(10 * SEGMENT + 123)
+
+
+class Body(httpx.AsyncByteStream):
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        for start in range(0, len(DATA), 1024):
+            await asyncio.sleep(0)
+            yield DATA[start : start + 1024]
+
+
+class Upstream(object):
+    """Serves `DATA`, and byte ranges of it, counting range requests in flight."""
+
+    def __init__(self, failures: int = 0):
+        self.failures = failures
+        self.in_flight = 0
+        self.peak = 0
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        headers = {"accept-ranges": "bytes", "etag": '"a"'}
+        if "range" not in request.headers:
+            headers["content-length"] = str(len(DATA))
+            return httpx.Response(200, headers=headers, stream=Body())
+        if self.failures:
+            self.failures -= 1
+            return httpx.Response(500)
+
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        try:
+            await asyncio.sleep(0.01)
+        finally:
+            self.in_flight -= 1
+        match = re.fullmatch(r"bytes=(\d+)-(\d+)", request.headers["range"])
+        assert match is not None
+        start, end = map(int, match.groups())
+        headers["content-range"] = f"bytes {start}-{end}/{len(DATA)}"
+        return httpx.Response(206, headers=headers, content=DATA[start : end + 1])
+
+
+async def download(client: httpx.AsyncClient) -> httpx.Response:
+    request = client.build_request("GET", "http://upstream/a")
+    resp = await client.send(request, stream=True)
+    return ranged_response(client, request, resp, SEGMENT, 3, 2 * SEGMENT)
+
+
+def test_round_trip() -> None:
+    async def main() -> None:
+        upstream = Upstream(failures=1)
+        transport = httpx.MockTransport(upstream.handle)
+        async with httpx.AsyncClient(transport=transport) as client:
+            resp = await download(client)
+            assert await resp.aread() == DATA
+        assert upstream.peak <= 3
+
+    asyncio.run(main())
+
+
+def test_close_cancels_segment_fetches() -> None:
+    async def main() -> None:
+        upstream = Upstream()
+        transport = httpx.MockTransport(upstream.handle)
+        async with httpx.AsyncClient(transport=transport) as client:
+            resp = await download(client)
+            async for _ in resp.aiter_raw():
+                break
+            assert isinstance(resp.stream, RangedStream)
+            segments = list(resp.stream.segments)
+            assert segments and upstream.in_flight
+
+            await resp.aclose()
+            assert all(task.done() for task in segments)
+            assert upstream.in_flight == 0
+
+    asyncio.run(main())